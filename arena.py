@@ -0,0 +1,176 @@
+import logging
+import threading
+
+from Queue import Queue, Empty
+
+import asyncPipe
+import quake2
+
+from build import cpuCount
+
+# Cores to set aside for each match (q2ded plus its bots) when the arena
+# count is derived from the machine
+CORES_PER_ARENA = 4
+
+class ArenaPool(object):
+	"""
+	A set of quake2 dedicated servers, each with its own port and game
+	directory, that play matches side by side. Heats are shared out between
+	the arenas and the results of every heat that finished are kept even if
+	another one failed.
+	"""
+
+	def __init__(self, config):
+
+		self.logf = logging.getLogger('Arenas')
+
+		count = config.get('arena.count') or max(1, cpuCount() / CORES_PER_ARENA)
+		basePort = config['quake2.port']
+
+		if count == 1:
+			self.arenas = [ quake2.Server(config) ]
+		else:
+			self.arenas = [ quake2.Server(config, basePort + i, 'arena%d' % i) for i in range(count) ]
+
+		self.options = None
+		self.map = None
+
+	def __len__(self):
+		return len(self.arenas)
+
+	def launch(self, options, map):
+		"""
+		Launches every arena's server and waits for all of them to be ready.
+		"""
+
+		self.options = options
+		self.map = map
+
+		self.logf.info('Launching %d arena(s)', len(self.arenas))
+		self.forEach(self.arenas, lambda arena: arena.launch(options, map))
+
+	def kill(self):
+
+		self.forEach(self.arenas, lambda arena: arena.kill())
+
+	def runHeats(self, timelimit, heats):
+		"""
+		Plays each heat (a list of bots) in the next free arena, back to back,
+		and returns the heats that completed, less any bots that failed to
+		connect. An arena whose match fails has its bots killed and its server
+		relaunched before it takes another heat; one that can't be relaunched
+		leaves its share of the heats to the others.
+		"""
+
+		queue = Queue()
+		for heat in heats:
+			queue.put(heat)
+
+		completed = []
+		mutex = threading.Lock()
+
+		def play(arena):
+			while True:
+				try:
+					heat = queue.get_nowait()
+				except Empty:
+					return
+
+				try:
+					arena.runGame(timelimit, heat)
+				except:
+					self.logf.error('%s failed, discarding results for %d bots', arena.name, len(heat), exc_info=True)
+				else:
+					# Bots that couldn't connect have no results
+					with mutex:
+						completed.append([ bot for bot in heat if bot.name in arena.clients ])
+					continue
+
+				# Leave the remaining heats to the other arenas if this one
+				# can't be brought back
+				try:
+					self.reset(arena, heat)
+				except:
+					self.logf.error('%s could not be reset, it takes no more heats', arena.name, exc_info=True)
+					return
+
+		self.forEach(self.arenas[:len(heats)], play, raiseErrors=False)
+
+		if not queue.empty():
+			self.logf.error('%d heats left unplayed, no arena could take them', queue.qsize())
+		return completed
+
+	def reset(self, arena, bots=()):
+		"""
+		Kills the bots and gets the arena ready for another match, reusing the
+		running server if it responds to commands and relaunching it if not.
+		"""
+
+		for bot in bots:
+			proc = getattr(bot, 'proc', None)
+			if proc:
+				asyncPipe.processList.killPid(proc.pid)
+
+		if arena.reset(bots):
+			self.logf.info('%s reset in place', arena.name)
+			return
+
+		self.relaunch(arena)
+
+	def relaunch(self, arena):
+
+		try:
+			arena.kill()
+		except:
+			self.logf.error('Failed to stop %s', arena.name, exc_info=True)
+		arena.launch(self.options, self.map)
+
+	def resetAll(self):
+		"""
+		Resets every arena. One that can't be brought back is logged and left
+		for the next heat it is given to try again.
+		"""
+
+		self.forEach(self.arenas, self.reset, raiseErrors=False)
+
+	def changeMap(self, map):
+		"""
+		Switches every arena to map, relaunching any that can't change in place.
+		"""
+
+		self.map = map
+
+		def change(arena):
+			try:
+				arena.changeMap(map)
+			except:
+				self.logf.warning('%s failed to change map, relaunching', arena.name, exc_info=True)
+				self.relaunch(arena)
+
+		self.forEach(self.arenas, change)
+
+	def forEach(self, arenas, action, raiseErrors=True):
+		"""
+		Applies action to each arena from its own thread. Returns a map of
+		arena to the exception it raised, or raises the first one.
+		"""
+
+		failures = {}
+
+		def run(arena):
+			try:
+				action(arena)
+			except Exception, e:
+				self.logf.error('%s: %s', arena.name, e, exc_info=True)
+				failures[arena] = e
+
+		threads = [ threading.Thread(name='%s:match' % arena.name, target=run, args=(arena,)) for arena in arenas ]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		if failures and raiseErrors:
+			raise failures.values()[0]
+
+		return failures
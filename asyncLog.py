@@ -0,0 +1,203 @@
+from __future__ import with_statement
+import atexit
+import logging
+import threading
+import time
+
+from Queue import Queue, Full
+
+import metrics
+
+# Records waiting for the writer thread before chatty ones are dropped
+QUEUE_SIZE = 10000
+
+# Logger names whose limit is remembered before the memo is cleared
+MEMO_SIZE = 4096
+
+# Records per second (and burst) let through from each chatty channel, by
+# logger name prefix; overridden by log.limits
+DEFAULT_LIMITS = {
+	'Q2Console':(200.0, 1000),
+	'Bot':(100.0, 500),
+	'Main.source':(50.0, 200),
+}
+
+DROPPED = metrics.counter('q2gp_log_dropped_total', 'Log records dropped because the writer fell behind')
+SUPPRESSED = metrics.counter('q2gp_log_suppressed_total', 'Log records held back by a rate limit or sampling')
+
+class Limit(object):
+	"A token bucket, and optionally keeping one record in every sample"
+
+	def __init__(self, rate, burst, sample=1):
+		self.rate = rate
+		self.burst = burst
+		self.sample = sample
+		self.tokens = burst
+		self.stamp = time.time()
+		self.seen = 0
+
+	def allow(self):
+
+		self.seen = self.seen + 1
+		if self.sample > 1 and self.seen % self.sample:
+			return False
+		if not self.rate:
+			return True
+
+		now = time.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		if self.tokens < 1:
+			return False
+		self.tokens = self.tokens - 1
+		return True
+
+class RateLimiter(object):
+	"""
+	Applies the limit of the longest matching logger name prefix to records
+	below WARNING. Warnings and errors always get through.
+	"""
+
+	def __init__(self, limits=None, samples=None):
+		self.mutex = threading.Lock()
+		self.configure(limits, samples)
+
+	def configure(self, limits=None, samples=None):
+
+		if limits is None:
+			limits = DEFAULT_LIMITS
+		samples = samples or {}
+
+		table = {}
+		for prefix in set(limits.keys() + samples.keys()):
+			rate, burst = limits.get(prefix) or (None, 0)
+			table[prefix] = Limit(rate, burst, samples.get(prefix) or 1)
+
+		with self.mutex:
+			self.limits = table
+			self.prefixes = sorted(table, key=len, reverse=True)
+			self.byName = {}
+
+	def limitFor(self, name):
+
+		limit = self.byName.get(name, False)
+		if limit is False:
+			limit = None
+			for prefix in self.prefixes:
+				if name == prefix or name.startswith(prefix + '.'):
+					limit = self.limits[prefix]
+					break
+			if len(self.byName) >= MEMO_SIZE:
+				self.byName.clear()
+			self.byName[name] = limit
+		return limit
+
+	def allow(self, record):
+
+		if record.levelno >= logging.WARNING:
+			return True
+
+		with self.mutex:
+			limit = self.limitFor(record.name)
+			if limit is None or limit.allow():
+				return True
+
+		SUPPRESSED.inc()
+		return False
+
+class QueueHandler(logging.Handler):
+	"""
+	Hands records to a QueueListener instead of writing them. The message
+	and any traceback are rendered up front, while the arguments still
+	hold the values they had at the call and the frames still exist; the
+	writer thread only lays out the line. When the queue is full records
+	below WARNING are dropped rather than making the caller wait.
+	"""
+
+	def __init__(self, queue, limiter=None):
+		logging.Handler.__init__(self)
+		self.queue = queue
+		self.limiter = limiter
+
+	def emit(self, record):
+
+		if self.limiter and not self.limiter.allow(record):
+			return
+
+		try:
+			record.msg = record.getMessage()
+			record.args = None
+			if record.exc_info:
+				record.exc_text = logging.Formatter().formatException(record.exc_info)
+				record.exc_info = None
+
+			if record.levelno >= logging.WARNING:
+				self.queue.put(record)
+			else:
+				self.queue.put_nowait(record)
+		except Full:
+			DROPPED.inc()
+		except:
+			self.handleError(record)
+
+class QueueListener(object):
+	"Writes queued records to the real handlers from a background thread"
+
+	def __init__(self, queue, handlers):
+		self.queue = queue
+		self.handlers = handlers
+		self.thread = None
+
+	def start(self):
+
+		self.thread = threading.Thread(name='LogWriter', target=self.run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		"Writes out everything queued so far and stops the thread"
+
+		if self.thread:
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+
+		for handler in self.handlers:
+			handler.flush()
+
+	def run(self):
+
+		while True:
+			record = self.queue.get()
+			if record is None:
+				return
+
+			for handler in self.handlers:
+				if record.levelno >= handler.level:
+					handler.handle(record)
+
+limiter = RateLimiter()
+
+def install(queueSize=QUEUE_SIZE):
+	"""
+	Moves the root logger's handlers behind a queue and a writer thread, so
+	that logging never blocks on disk or terminal I/O. Returns the listener,
+	which is also stopped at exit.
+	"""
+
+	queue = Queue(queueSize)
+	root = logging.getLogger()
+	handlers = list(root.handlers)
+	for handler in handlers:
+		root.removeHandler(handler)
+
+	listener = QueueListener(queue, handlers).start()
+	root.addHandler(QueueHandler(queue, limiter))
+	atexit.register(listener.stop)
+	return listener
+
+def configure(config):
+	"Applies log.limits and log.sample from the client configuration"
+
+	limiter.configure(config.get('log.limits'), config.get('log.sample'))
@@ -1,7 +1,10 @@
 from __future__ import with_statement
+import atexit
+import logging
 import os
 import subprocess
 import errno
+import io
 import time
 import sys
 import threading
@@ -17,17 +20,190 @@ if subprocess.mswindows:
 else:
 	from select import select
 	import fcntl
-	import signal
+
+import signal
+
+# Initial size of a LineReader's buffer, which grows to fit longer lines
+LINE_BUFFER = 65536
+
+def setNonBlocking(fd):
+
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	if not flags & os.O_NONBLOCK:
+		fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class LineReader(object):
+	"""
+	Reads whole lines from a pipe. The pipe is made non-blocking once, for
+	good, and each read() takes whatever is waiting with a single readinto
+	a buffer that is reused from one read to the next. Complete lines are
+	handed back and a partial last line stays where it is until the rest
+	of it arrives; it is only moved when the buffer fills up.
+	"""
+
+	def __init__(self, fd, size=LINE_BUFFER):
+
+		setNonBlocking(fd)
+		self.file = io.FileIO(fd, 'r', closefd=False)
+		self.buffer = bytearray(size)
+		self.view = memoryview(self.buffer)
+		self.start = 0
+		self.end = 0
+
+	def read(self):
+		"""
+		Returns the lines completed by what could be read without waiting,
+		without their newlines. The list is empty if nothing was waiting,
+		and None is returned at end of file once any unterminated last line
+		has been handed back. More than one read is only needed when more is
+		waiting than there's room for in the buffer.
+		"""
+
+		lines = []
+		while True:
+			if self.end == len(self.buffer):
+				self.makeRoom()
+			room = len(self.buffer) - self.end
+
+			try:
+				count = self.file.readinto(self.view[self.end:])
+			except IOError, why:
+				if why[0] in (errno.EAGAIN, errno.EINTR):
+					return lines
+				raise
+			if count is None:
+				return lines
+			if not count:
+				# A last line without a newline is still a line
+				if self.end > self.start:
+					lines.append(self.view[self.start:self.end].tobytes())
+					self.start = self.end = 0
+				return lines or None
+
+			self.end = self.end + count
+			self.split(lines)
+			if count < room:
+				return lines
+
+	def split(self, lines):
+		"Appends the complete lines in the buffer to lines"
+
+		find = self.buffer.find
+		view = self.view
+		start = self.start
+		end = find('\n', start, self.end)
+		while end >= 0:
+			lines.append(view[start:end].tobytes())
+			start = end + 1
+			end = find('\n', start, self.end)
+
+		if start == self.end:
+			self.start = self.end = 0
+		else:
+			self.start = start
+
+	def makeRoom(self):
+		"Moves a partial line to the front of the buffer, or grows the buffer"
+
+		tail = self.end - self.start
+		if self.start:
+			self.buffer[:tail] = self.view[self.start:self.end].tobytes()
+		else:
+			# The memoryview must go before the buffer can be resized
+			self.view = None
+			self.buffer.extend(bytearray(len(self.buffer)))
+			self.view = memoryview(self.buffer)
+		self.start = 0
+		self.end = tail
+
+def newProcessGroup(preexec_fn=None):
+	"Wraps preexec_fn so that the child first leaves our process group"
+	def setup():
+		os.setpgrp()
+		if preexec_fn:
+			preexec_fn()
+	return setup
+
+# Seconds between sweeps for exited processes, the only way exits are
+# noticed where there are no pidfds
+POLL_INTERVAL = 1.0
+
+# A pidfd becomes readable when its process exits (Linux 5.3 and later);
+# the syscall number is the same on every architecture
+SYS_PIDFD_OPEN = 434
+
+PR_SET_CHILD_SUBREAPER = 36
+
+libc = None
+if sys.platform.startswith('linux'):
+	try:
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+	except (ImportError, OSError):
+		pass
+
+def pidfdOpen(pid):
+	"Returns a pidfd for pid, or None if the kernel can't provide one"
+
+	if libc is None:
+		return None
+	fd = libc.syscall(SYS_PIDFD_OPEN, pid, 0)
+	if fd < 0:
+		return None
+	return fd
+
+def becomeSubreaper():
+	"""
+	Has the orphans of our children handed to us rather than to init, which
+	in a container may never reap them.
+	"""
+
+	if libc is not None:
+		libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+
+SIGNAL_NAMES = {}
+for name in sorted(dir(signal), reverse=True):
+	if name.startswith('SIG') and not name.startswith('SIG_'):
+		SIGNAL_NAMES[getattr(signal, name)] = name
+
+def exitReason(returncode):
+
+	if returncode is None:
+		return 'still running'
+	if returncode < 0:
+		return 'killed by %s' % SIGNAL_NAMES.get(-returncode, 'signal %d' % -returncode)
+	return 'exited with status %d' % returncode
 
 class ProcessList():
+	"""
+	Supervises every child the client launches. Each one is started in a
+	process group of its own so that anything it forks can be killed with
+	it. A supervisor thread waits on the children's pidfds, or sweeps them
+	every POLL_INTERVAL seconds without, and as soon as one exits it is
+	reaped, whatever is left of its group is killed (and reaped in turn,
+	since orphans are handed to us) and its watchers are told why it went
+	away.
+	"""
+
 	def __init__(self):
 		
+		self.logf = logging.getLogger('Supervisor')
 		self.mutex = threading.RLock()
 		self.processes = {}
+		self.groups = set()
+		self.thread = None
+		if not subprocess.mswindows:
+			self.wakeRead, self.wakeWrite = os.pipe()
 		
 	def put(self, proc):
 		with self.mutex:
 			self.processes[proc.pid] = proc
+			if not self.thread:
+				becomeSubreaper()
+				self.thread = threading.Thread(name='Supervisor', target=self.run)
+				self.thread.setDaemon(True)
+				self.thread.start()
+		self.wake()
 	
 	def remove(self, pid):
 		with self.mutex:
@@ -35,41 +211,187 @@ class ProcessList():
 				del self.processes[pid]
 	
 	def cleanupProcesses(self):
+		"Kills every process that wasn't launched as persistent"
+		with self.mutex:
+			for pid, proc in self.processes.items():
+				if not proc.persistent:
+					self.killPid(pid)
+
+	def killAll(self):
 		with self.mutex:
 			for pid in self.processes.keys():
 				self.killPid(pid)
 
 	if subprocess.mswindows:
+		def wake(self):
+			pass
+
 		def killPid(self, pid):
 			with self.mutex:
 				TerminateProcess(pid)
-				self.remove(pid)
+
+		def killGroup(self, pid):
+			pass
+
+		def reapGroups(self):
+			pass
+
+		def wait(self):
+			time.sleep(POLL_INTERVAL)
 	else:
+		def wake(self):
+			os.write(self.wakeWrite, 'x')
+
 		def killPid(self, pid):
-			with self.mutex:
+			"Kills pid and everything in its process group"
+			try:
+				os.killpg(pid, signal.SIGKILL)
+			except OSError:
 				try:
 					os.kill(pid, signal.SIGKILL)
-				except:
+				except OSError:
 					pass #process is already dead
-				self.remove(pid)
+
+		def killGroup(self, pid):
+			"""
+			Kills whatever an exited process left behind in its group. The
+			group id can't be handed out again while any of them is alive.
+			"""
+			try:
+				os.killpg(pid, signal.SIGKILL)
+			except OSError:
+				return
+			self.groups.add(pid)
+
+		def reapGroups(self):
+			"Reaps what was left of the groups of exited processes"
+
+			for pgid in list(self.groups):
+				try:
+					while os.waitpid(-pgid, os.WNOHANG)[0]:
+						pass
+				except OSError:
+					# Nothing of the group is left
+					self.groups.discard(pgid)
+
+		def wait(self):
+
+			with self.mutex:
+				fds = [ proc.pidfd for proc in self.processes.itervalues() if proc.pidfd is not None ]
+
+			ready, _, _ = select(fds + [self.wakeRead], [], [], POLL_INTERVAL)
+			if self.wakeRead in ready:
+				os.read(self.wakeRead, 4096)
+
+	def run(self):
+
+		while True:
+			self.wait()
+			self.reap()
+
+	def reap(self):
+
+		with self.mutex:
+			processes = self.processes.values()
+
+		for proc in processes:
+			if proc.poll() is None:
+				continue
+
+			self.remove(proc.pid)
+			self.killGroup(proc.pid)
+			if self.logf.isEnabledFor(logging.DEBUG):
+				self.logf.debug('%s (pid %d) %s', proc.command, proc.pid, proc.exitReason())
+			proc.exited()
+
+		self.reapGroups()
 
 processList = ProcessList()
+atexit.register(processList.killAll)
 
 class Popen(subprocess.Popen):
+	"""
+	A child process with non-blocking pipes, supervised by processList.
+	Persistent processes (the quake2 servers) are left running when the
+	rest are cleaned up after a failed match.
+	"""
 	
 	def __init__(self, args, bufsize=0, executable=None,
 				stdin=None, stdout=None, stderr=None,
 				preexec_fn=None, close_fds=False, shell=False,
 				cwd=None, env=None, universal_newlines=False,
-				startupinfo=None, creationflags=0):
+				startupinfo=None, creationflags=0, persistent=False):
+		
+		self.persistent = persistent
+		self.command = os.path.basename(isinstance(args, basestring) and args or args[0])
+		self.pidfd = None
+		self.watchers = []
+		self.readers = {}
+		self.reaping = threading.Lock()
+		self.done = threading.Event()
+		
+		if not subprocess.mswindows:
+			preexec_fn = newProcessGroup(preexec_fn)
 		
 		subprocess.Popen.__init__(self, args, bufsize, executable,
 										stdin, stdout, stderr, preexec_fn, 
 										close_fds, shell, cwd, env, 
 										universal_newlines, startupinfo, 
 										creationflags)
+		self.pidfd = pidfdOpen(self.pid)
 		processList.put(self)
 	
+	def poll(self):
+		# Only one thread at a time may reap the process, another would
+		# be told it never existed
+		with self.reaping:
+			return subprocess.Popen.poll(self)
+	
+	def wait(self):
+		while self.poll() is None:
+			self.done.wait(POLL_INTERVAL)
+		return self.returncode
+	
+	def exitReason(self):
+		return exitReason(self.returncode)
+	
+	def lineReader(self, which='stdout'):
+		"""
+		The LineReader for the stdout (or stderr) pipe, which is left
+		non-blocking from then on.
+		"""
+		reader = self.readers.get(which)
+		if reader is None:
+			reader = self.readers[which] = LineReader(getattr(self, which).fileno())
+		return reader
+	
+	def watch(self, callback):
+		"""
+		Calls callback with this process once it has exited and been reaped,
+		from the supervisor's thread, or straight away if that has happened.
+		"""
+		with self.reaping:
+			if not self.done.isSet():
+				self.watchers.append(callback)
+				return
+		callback(self)
+	
+	def exited(self):
+		"Called by the supervisor once the process has been reaped"
+		
+		with self.reaping:
+			if self.pidfd is not None:
+				os.close(self.pidfd)
+				self.pidfd = None
+			self.done.set()
+			watchers, self.watchers = self.watchers, []
+		
+		for callback in watchers:
+			try:
+				callback(self)
+			except:
+				processList.logf.error('Exception in the exit watcher of %s', self.command, exc_info=True)
+	
 	if subprocess.mswindows:
 		def pollStdout(self, timeout):
 			
@@ -112,7 +434,6 @@ class Popen(subprocess.Popen):
 		return getattr(self, which), maxsize
 	
 	def _close(self, which):
-		processList.remove(self.pid)
 		getattr(self, which).close()
 		setattr(self, which, None)
 	
@@ -178,22 +499,19 @@ class Popen(subprocess.Popen):
 			if conn is None:
 				return None
 			
-			flags = fcntl.fcntl(conn, fcntl.F_GETFL)
-			if not conn.closed:
-				fcntl.fcntl(conn, fcntl.F_SETFL, flags| os.O_NONBLOCK)
-			
+			# The pipe is left non-blocking after the first call
+			setNonBlocking(conn.fileno())
 			try:
-				if not select([conn], [], [], 0)[0]:
+				r = os.read(conn.fileno(), maxsize)
+			except OSError, why:
+				if why[0] in (errno.EAGAIN, errno.EINTR):
 					return ''
-				
-				r = conn.read(maxsize)
-				if not r:
-					return self._close(which)
-	
-				if self.universal_newlines:
-					r = self._translate_newlines(r)
-				return r
-			finally:
-				if not conn.closed:
-					fcntl.fcntl(conn, fcntl.F_SETFL, flags)
+				raise
+			
+			if not r:
+				return self._close(which)
+
+			if self.universal_newlines:
+				r = self._translate_newlines(r)
+			return r
 
@@ -0,0 +1,112 @@
+"""
+Microbenchmark for the Quake2 console parser. Compares the original
+compile-per-line template list against quake2.parseConsoleLine on a
+synthetic console log with a realistic mix of obituaries and chatter.
+
+	python bench/consoleBench.py [lines]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import quake2
+
+def legacyParse(msg):
+	"The parser as it was before the templates were compiled at import"
+
+	def message(s):
+		return re.compile( s.replace('__', '[^ ]+') + '\\n' )
+
+	frag, suicide, server = 'frag', 'suicide', 'server'
+	messageTemplates = [
+		 (message('(__)( was blasted by )(__)'), frag),
+		 (message('(__)( was gunned down by )(__)'), frag),
+		 (message('(__)( was blown away by )(__)(\'s super shotgun)'), frag),
+		 (message('(__)( was machinegunnged by )(__)'), frag),
+		 (message('(__)( was cut in half by )(__)(\'s chaingun)'), frag),
+		 (message('(__)( was popped by )(__)(\'s grenade)'), frag),
+		 (message('(__)( ate )(__)(\'s rocket)'), frag),
+		 (message('(__)( almost dodged )(__)(\'s rocket)'), frag),
+		 (message('(__)( was melted by )(__)(\'s hyperblaster)'), frag),
+		 (message('(__)( was railed by )(__)'), frag),
+		 (message('(__)( saw the pretty lights from )(__)(\'s BFG)'), frag),
+		 (message('(__)( was disintegrated by )(__)(\'s BFG blast)'), frag),
+		 (message('(__)( couldn\'t hide from )(__)(\'s BFG)'), frag),
+		 (message('(__)( caught )(__)(\'s handgrenade)'), frag),
+		 (message('(__)( didn\'t see )(__)(\'s handgrenade)'), frag),
+		 (message('(__)( feels )(__)(\'s pain)'), frag),
+		 (message('(__)( tried to invade )(__)(\'s personal space)'), frag),
+		 (message('(__)( suicides)'), suicide),
+		 (message('(__)( cratered)'), suicide),
+		 (message('(__)( was squished)'), suicide),
+		 (message('(__)( sank like a rock)'), suicide),
+		 (message('(__)( melted)'), suicide),
+		 (message('(__)( does a back flip into the lava)'), suicide),
+		 (message('(__)( blew up)'), suicide),
+		 (message('(__)( found a way out)'), suicide),
+		 (message('(__)( saw the light)'), suicide),
+		 (message('(__)( was in the wrong place)'), suicide),
+		 (message('(__)( tried to put the pin back in)'), suicide),
+		 (message('(__)( tripped on (its|her|his) own grenade)'), suicide),
+		 (message('(__)( blew (itself|herself|himself) up)'), suicide),
+		 (message('(__)( should have used a smaller gun)'), suicide),
+		 (message('(__)( killed (itself|herself|himself))'), suicide),
+		 (message('-------- Server Initialized ---------'), server),
+		 (message('-------------------------------------'), server)
+		 ]
+
+	for (expr,handler) in messageTemplates:
+		match = expr.match(msg)
+		if match:
+			return handler, match
+
+	return None,None
+
+def consoleLines(count, seed=0):
+	"A synthetic console log: mostly obituaries with some server chatter"
+
+	rng = random.Random(seed)
+	names = [ 'bot%02d' % i for i in range(16) ]
+	chatter = [ '%s entered the game\n', '%s disconnected\n', ']status\n', 'Sending heartbeat to master\n' ]
+
+	lines = []
+	for i in range(count):
+		roll = rng.random()
+		victim, attacker = rng.sample(names, 2)
+		if roll < 0.6:
+			verb, suffix = rng.choice(quake2.FRAG_OBITUARIES)
+			lines.append('%s %s %s%s\n' % (victim, verb, attacker, suffix))
+		elif roll < 0.8:
+			lines.append('%s %s\n' % (victim, rng.choice(quake2.SUICIDE_OBITUARIES)))
+		else:
+			line = rng.choice(chatter)
+			lines.append('%s' in line and line % victim or line)
+
+	return lines
+
+def measure(parse, lines):
+
+	started = time.time()
+	for line in lines:
+		parse(line)
+	return len(lines) / (time.time() - started)
+
+def main():
+
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+	lines = consoleLines(count)
+
+	before = measure(legacyParse, lines)
+	after = measure(quake2.parseConsoleLine, lines)
+
+	print 'console lines:   %d' % count
+	print 'before:          %12.0f lines/s' % before
+	print 'after:           %12.0f lines/s' % after
+	print 'speedup:         %12.1fx' % (after / before)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+A stand-in for a compiled bot. It answers every command on stdin with
+'return <command>' and exits after 'quit'. On 'connect <host> <port>' it
+registers its name with the fake q2ded on that port by creating a file in
+$FAKE_Q2_CLIENTS/<port>/, which is removed again on 'disconnect', so that
+the server can name it in obituaries.
+
+	fakeBot.py <name>
+
+	FAKE_BOT_LATENCY	seconds to wait before each reply (default 0)
+	FAKE_BOT_NOISE		lines of chatter to print before each reply (default 0)
+	FAKE_Q2_CLIENTS		directory shared with bench/fakeQ2ded.py
+
+Built as the output of bench/fakeGpp.py by pointing FAKE_GPP_OUTPUT here.
+"""
+import os
+import sys
+import time
+
+def register(name, port, connected):
+
+	clients = os.environ.get('FAKE_Q2_CLIENTS')
+	if not clients or not port:
+		return
+
+	directory = os.path.join(clients, port)
+	path = os.path.join(directory, name)
+	try:
+		if connected:
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+			open(path, 'w').close()
+		elif os.path.exists(path):
+			os.remove(path)
+	except OSError:
+		pass
+
+def main(args):
+
+	name = args and args[0] or 'fakebot%d' % os.getpid()
+	latency = float(os.environ.get('FAKE_BOT_LATENCY', '0'))
+	noise = int(os.environ.get('FAKE_BOT_NOISE', '0'))
+	port = None
+
+	while True:
+		line = sys.stdin.readline()
+		if not line:
+			return 0
+
+		command = line.split()
+		if not command:
+			continue
+
+		if command[0] == 'connect' and len(command) > 2:
+			port = command[2]
+			register(name, port, True)
+		elif command[0] == 'disconnect':
+			register(name, port, False)
+
+		if latency:
+			time.sleep(latency)
+		for i in range(noise):
+			sys.stdout.write('%s: thinking %d\n' % (name, i))
+		sys.stdout.write('return %s\n' % line.strip())
+		sys.stdout.flush()
+
+		if command[0] == 'quit':
+			register(name, port, False)
+			return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
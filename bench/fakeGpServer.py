@@ -0,0 +1,92 @@
+"""
+A local stand-in for the GP bot server. It hands out generations of
+trivial bots over the GETBOTS protocol, optionally pausing between bots to
+mimic a slow link, and records whatever is sent back with POSTRESULTS.
+
+	python bench/fakeGpServer.py [port] [bots] [lines] [delay]
+"""
+import SocketServer
+import sys
+import threading
+import time
+
+class FakeGpServer(object):
+
+	def __init__(self, port=0, bots=16, lines=200, delay=0.0, host='127.0.0.1'):
+
+		self.bots = bots
+		self.lines = lines
+		self.delay = delay
+
+		self.mutex = threading.Lock()
+		self.generation = 0
+		self.results = []
+
+		server = self
+		class Handler(SocketServer.StreamRequestHandler):
+			def handle(self):
+				server.handle(self.rfile, self.wfile)
+
+		SocketServer.ThreadingTCPServer.allow_reuse_address = True
+		self.server = SocketServer.ThreadingTCPServer((host, port), Handler)
+		self.server.daemon_threads = True
+		self.host, self.port = self.server.server_address
+		self.thread = None
+
+	def start(self):
+
+		self.thread = threading.Thread(name='FakeGpServer', target=self.server.serve_forever)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+
+		self.server.shutdown()
+		self.server.server_close()
+
+	def botCode(self, name):
+
+		code = [ '// %s statement %d\n' % (name, i) for i in range(self.lines) ]
+		code.append('int main(int argc, char **argv) { return 0; }\n')
+		return code
+
+	def handle(self, rfile, wfile):
+
+		command = rfile.readline().strip()
+		if command == 'GETBOTS':
+			with self.mutex:
+				self.generation = self.generation + 1
+				generation = self.generation
+
+			wfile.write('token%d\n' % generation)
+			for i in range(self.bots):
+				if self.delay:
+					wfile.flush()
+					time.sleep(self.delay)
+
+				name = 'g%db%02d' % (generation, i)
+				wfile.write('STARTBOT %s\n' % name)
+				wfile.writelines(self.botCode(name))
+				wfile.write('ENDBOT %s\n' % name)
+
+		elif command == 'POSTRESULTS':
+			token = rfile.readline().strip()
+			results = [ line.split() for line in rfile ]
+			with self.mutex:
+				self.results.append((token, results))
+
+def main():
+
+	args = map(float, sys.argv[1:]) + [ None ] * 4
+	port, bots, lines, delay = args[:4]
+	server = FakeGpServer(int(port or 28000), int(bots or 16), int(lines or 200), delay or 0.0).start()
+	print 'Fake GP server listening on %s:%d' % (server.host, server.port)
+	try:
+		while True:
+			time.sleep(1.0)
+	except KeyboardInterrupt:
+		server.stop()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+A stand-in for g++ with a tunable latency. It understands just enough of
+the command line to find the output file, which it writes as a small
+executable. Sources containing FAKE_GPP_ERROR, including one read from
+stdin, fail to build.
+
+	FAKE_GPP_LATENCY	seconds to spend per invocation (default 0.1)
+	FAKE_GPP_OUTPUT		file whose contents become every output
+"""
+import os
+import sys
+import time
+
+def main(args):
+
+	if '--version' in args:
+		print('fakeg++ 1.0')
+		return 0
+
+	time.sleep(float(os.environ.get('FAKE_GPP_LATENCY', '0.1')))
+
+	output = None
+	if '-o' in args:
+		output = args[args.index('-o') + 1]
+
+	for arg in args:
+		if arg == '-':
+			source = sys.stdin.read()
+		elif arg.endswith('.cpp') and os.path.exists(arg):
+			source = open(arg).read()
+		else:
+			continue
+		if 'FAKE_GPP_ERROR' in source:
+			sys.stderr.write('%s:1:1: error: FAKE_GPP_ERROR\n' % (arg == '-' and '<stdin>' or arg))
+			return 1
+
+	if output:
+		template = os.environ.get('FAKE_GPP_OUTPUT')
+		fp = open(output, 'w')
+		fp.write(template and open(template).read() or '#!/bin/sh\n')
+		fp.close()
+		os.chmod(output, 0o755)
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
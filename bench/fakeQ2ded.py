@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+A stand-in for the Quake2 dedicated server. It takes q2ded's command line,
+writes the server-initialized banner to <basedir>/<game>/qconsole.log and
+then fills the log with obituaries and chatter at a steady rate while at
+least one bot is registered on its port (see bench/fakeBot.py). It obeys
+map, status, kick and quit on stdin the way q2ded's console does.
+
+	FAKE_Q2DED_RATE		obituaries per second (default 20)
+	FAKE_Q2DED_CHATTER	lines of other console output per obituary (default 1)
+	FAKE_Q2DED_SEED		seed for the choice of victims and weapons
+	FAKE_Q2_CLIENTS		directory shared with bench/fakeBot.py
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+FRAGS = [
+	('was blasted by', ''),
+	('was gunned down by', ''),
+	('was blown away by', '\'s super shotgun'),
+	('was machinegunned by', ''),
+	('was cut in half by', '\'s chaingun'),
+	('ate', '\'s rocket'),
+	('was melted by', '\'s hyperblaster'),
+	('was railed by', ''),
+	('saw the pretty lights from', '\'s BFG'),
+	('tried to invade', '\'s personal space'),
+]
+
+SUICIDES = [ 'suicides', 'cratered', 'sank like a rock', 'blew himself up', 'tripped on his own grenade' ]
+
+CHATTER = [
+	'%s entered the game\n',
+	'%s: gg\n',
+	'Rocket launcher hit %s\n',
+	'%s picked up the Quad Damage\n',
+]
+
+BANNER = '-------- Server Initialized ---------\n'
+
+class FakeServer(object):
+
+	def __init__(self, args):
+
+		self.cvars = {}
+		self.map = None
+		i = 0
+		while i < len(args):
+			if args[i] == '+set' and i + 2 < len(args):
+				self.cvars[args[i + 1]] = args[i + 2]
+				i = i + 3
+			elif args[i] == '+map' and i + 1 < len(args):
+				self.map = args[i + 1]
+				i = i + 2
+			else:
+				i = i + 1
+
+		basedir = self.cvars.get('basedir', '.')
+		self.port = self.cvars.get('port', '27910')
+		self.log = open(os.path.join(basedir, self.cvars.get('game', 'baseq2'), 'qconsole.log'), 'a')
+
+		self.rate = float(os.environ.get('FAKE_Q2DED_RATE', '20'))
+		self.chatter = int(os.environ.get('FAKE_Q2DED_CHATTER', '1'))
+		self.random = random.Random(os.environ.get('FAKE_Q2DED_SEED'))
+		self.clientDir = os.environ.get('FAKE_Q2_CLIENTS')
+		self.kicked = set()
+
+		self.mutex = threading.Lock()
+		self.running = True
+
+	def write(self, text):
+
+		with self.mutex:
+			self.log.write(text)
+			self.log.flush()
+
+	def clients(self):
+
+		if not self.clientDir:
+			return []
+		try:
+			names = os.listdir(os.path.join(self.clientDir, self.port))
+		except OSError:
+			return []
+		return sorted([ name for name in names if name not in self.kicked ])
+
+	def obituary(self, clients):
+
+		victim = self.random.choice(clients)
+		if len(clients) < 2 or self.random.random() < 0.1:
+			return '%s %s\n' % (victim, self.random.choice(SUICIDES))
+
+		attacker = self.random.choice([ name for name in clients if name != victim ])
+		verb, suffix = self.random.choice(FRAGS)
+		return '%s %s %s%s\n' % (victim, verb, attacker, suffix)
+
+	def fight(self):
+
+		interval = self.rate and 1.0 / self.rate or 1.0
+		due = time.time()
+		while self.running:
+			due = due + interval
+			time.sleep(max(0.0, due - time.time()))
+
+			clients = self.clients()
+			if not clients or not self.rate:
+				due = time.time()
+				continue
+
+			lines = [ self.obituary(clients) ]
+			for i in range(self.chatter):
+				lines.append(self.random.choice(CHATTER) % self.random.choice(clients))
+			self.write(''.join(lines))
+
+	def status(self):
+
+		lines = [ 'map              : %s\n' % self.map,
+				'num score ping name            lastmsg address               qport \n',
+				'--- ----- ---- --------------- ------- --------------------- ------\n' ]
+		for i, name in enumerate(self.clients()):
+			lines.append('%3d %5d %4d %-15s %7d %-21s %5d\n' % (i, 0, 10, name, 0, '127.0.0.1:27901', i))
+		lines.append('\n')
+		self.write(''.join(lines))
+
+	def run(self):
+
+		self.write(BANNER)
+		fighter = threading.Thread(target=self.fight)
+		fighter.setDaemon(True)
+		fighter.start()
+
+		while True:
+			line = sys.stdin.readline()
+			if not line:
+				break
+
+			command = line.split()
+			if not command:
+				continue
+
+			if command[0] == 'quit':
+				break
+			elif command[0] in ('map', 'gamemap') and len(command) > 1:
+				self.map = command[1]
+				self.kicked.clear()
+				self.write(BANNER)
+			elif command[0] == 'status':
+				self.status()
+			elif command[0] == 'kick' and len(command) > 1:
+				self.kicked.add(command[1])
+				self.write('%s was kicked\n' % command[1])
+
+		self.running = False
+		return 0
+
+if __name__ == '__main__':
+	sys.exit(FakeServer(sys.argv[1:]).run())
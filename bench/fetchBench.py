@@ -0,0 +1,75 @@
+"""
+Measures how long it takes from asking the GP server for a generation
+until every bot in it is compiled, with and without overlapping the
+download and the builds. Runs against bench/fakeGpServer.py and
+bench/fakeGpp.py.
+
+	python bench/fetchBench.py [bots] [delay] [compile latency]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+os.chdir(os.path.join(BENCH_DIR, '..'))
+
+from client import Generation, Main
+from fakeGpServer import FakeGpServer
+
+def fetchThenBuild(main):
+
+	generation = Generation(0)
+	token = main.getBots(generation)
+	pool = main.builder.startPool('gen%d' % generation.number)
+	for bot in generation.bots:
+		pool.submit(bot)
+	main.compileBots(generation, pool)
+	main.cleanUp(generation)
+	return generation
+
+def streamed(main):
+
+	generation = main.fetchGeneration()
+	main.cleanUp(generation)
+	return generation
+
+def main():
+
+	bots = len(sys.argv) > 1 and int(sys.argv[1]) or 16
+	delay = len(sys.argv) > 2 and float(sys.argv[2]) or 0.05
+	os.environ['FAKE_GPP_LATENCY'] = len(sys.argv) > 3 and sys.argv[3] or '0.2'
+
+	logging.basicConfig(level=logging.WARNING)
+
+	workspace = tempfile.mkdtemp(prefix='fetchBench')
+	server = FakeGpServer(bots=bots, delay=delay).start()
+	try:
+		client = Main({
+			'gp.host':server.host,
+			'gp.port':server.port,
+			'path.g++':os.path.join(BENCH_DIR, 'fakeGpp.py'),
+			'path.workspace':workspace,
+			'path.cache':None,
+			'path.journal':os.path.join(workspace, 'journal'),
+			'path.spool':os.path.join(workspace, 'spool'),
+			'q2botcore.src':[],
+			'build.pch':None,
+			'arena.count':1,
+		})
+		client.journal.open()
+
+		for label, fetch in [ ('fetch then build', fetchThenBuild), ('streamed', streamed) ]:
+			started = time.time()
+			generation = fetch(client)
+			print '%-18s %s: %d bots ready in %.2f s' % (label, generation.token, len(generation.bots), time.time() - started)
+		client.journal.close()
+	finally:
+		server.stop()
+		shutil.rmtree(workspace, ignore_errors=True)
+
+if __name__ == '__main__':
+	main()
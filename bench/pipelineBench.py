@@ -0,0 +1,209 @@
+"""
+Runs the whole client pipeline against local stand-ins and reports its
+throughput: generations fetched from bench/fakeGpServer.py, compiled with
+bench/fakeGpp.py into copies of bench/fakeBot.py, and played on
+bench/fakeQ2ded.py, which writes obituaries at a steady rate. Reports
+generations per hour, the latency of each stage, the console lines parsed
+per second and the RPC round trip to a bot.
+
+	python bench/pipelineBench.py [generations] [bots] [match seconds] [obituaries/s] [report.json]
+
+	FAKE_GPP_LATENCY	seconds per compile (default 0.1)
+	FAKE_BOT_LATENCY	seconds a bot takes to answer (default 0)
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+os.chdir(os.path.join(BENCH_DIR, '..'))
+
+from bot import Bot
+from client import Main
+from fakeGpServer import FakeGpServer
+
+RPC_CALLS = 500
+
+STAGES = [ 'fetch+build', 'match', 'post', 'cleanup' ]
+
+def percentile(values, p):
+
+	values = sorted(values)
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(p * len(values)))]
+
+class ConsoleMeter(object):
+	"Counts the console lines a server handles and the time spent on them"
+
+	def __init__(self, server):
+
+		self.handle = server.consoleMessage
+		self.lines = 0
+		self.busy = 0.0
+		server.consoleMessage = self
+
+	def __call__(self, line):
+
+		started = time.time()
+		try:
+			return self.handle(line)
+		finally:
+			self.busy = self.busy + time.time() - started
+			self.lines = self.lines + 1
+
+def setUp(root):
+	"Lays out a fake quake2 install under root and returns its config"
+
+	quake2 = os.path.join(root, 'quake2')
+	os.makedirs(os.path.join(quake2, 'baseq2'))
+	os.symlink(os.path.join(BENCH_DIR, 'fakeQ2ded.py'), os.path.join(quake2, 'q2ded'))
+
+	os.environ['FAKE_Q2_CLIENTS'] = os.path.join(root, 'clients')
+	os.environ['FAKE_GPP_OUTPUT'] = os.path.join(BENCH_DIR, 'fakeBot.py')
+	os.environ.setdefault('FAKE_GPP_LATENCY', '0.1')
+
+	return {
+		'path.q2ded':os.path.join(quake2, 'q2ded'),
+		'path.baseq2':os.path.join(quake2, 'baseq2'),
+		'path.g++':os.path.join(BENCH_DIR, 'fakeGpp.py'),
+		'path.workspace':os.path.join(root, 'workspace'),
+		'path.cache':None,
+		'path.events':None,
+		'path.spool':os.path.join(root, 'spool'),
+		'path.journal':os.path.join(root, 'journal'),
+		'q2botcore.src':[],
+		'build.pch':None,
+		'arena.count':1,
+		'gp.prefetch':0,
+	}
+
+def playGenerations(main, count):
+	"Plays count generations the way Main.run does, timing each stage"
+
+	timings = dict([ (stage, []) for stage in STAGES ])
+	connects = []
+
+	def timed(stage, fn, *args):
+		started = time.time()
+		result = fn(*args)
+		timings[stage].append(time.time() - started)
+		return result
+
+	started = time.time()
+	for i in range(count):
+		generation = timed('fetch+build', main.fetchGeneration)
+		if not generation:
+			raise SystemError('No bots received from the fake GP server')
+		timed('match', main.runGame, generation)
+		connects.extend([ arena.connectLatency for arena in main.arenas.arenas if arena.connectLatency is not None ])
+		timed('post', main.postResults, generation)
+		timed('cleanup', main.cleanUp, generation)
+		print 'generation %d: %d bots, %d finished' % (generation.number, len(generation.bots), len(generation.finishers))
+
+	timings['connect'] = connects
+	return time.time() - started, timings
+
+def measureRpc(root):
+	"Round trips of one command at a time, then of RPC_CALLS commands in flight at once"
+
+	exe = os.path.join(root, 'rpcbot')
+	shutil.copy(os.path.join(BENCH_DIR, 'fakeBot.py'), exe)
+	bot = Bot('rpcbot')
+	bot.exe = exe
+	bot.launch()
+	try:
+		trips = []
+		for i in range(RPC_CALLS):
+			started = time.time()
+			bot.proxyCall('ping %d' % i)
+			trips.append(time.time() - started)
+
+		started = time.time()
+		futures = [ bot.callAsync('ping %d' % i) for i in range(RPC_CALLS) ]
+		for future in futures:
+			future.result(30.0)
+		pipelined = RPC_CALLS / (time.time() - started)
+	finally:
+		bot.callAsync('quit').result(5.0)
+
+	return trips, pipelined
+
+def main():
+
+	args = sys.argv[1:] + [ None ] * 5
+	generations = int(args[0] or 3)
+	bots = int(args[1] or 8)
+	matchLength = float(args[2] or 5.0)
+	os.environ['FAKE_Q2DED_RATE'] = args[3] or '50'
+	reportPath = args[4]
+
+	logging.basicConfig(level=logging.ERROR)
+
+	root = tempfile.mkdtemp(prefix='pipelineBench')
+	server = FakeGpServer(bots=bots).start()
+	try:
+		config = setUp(root)
+		config.update({
+			'gp.host':server.host,
+			'gp.port':server.port,
+			'match.timelimit':matchLength / 60.0,
+		})
+		client = Main(config)
+		meters = [ ConsoleMeter(arena) for arena in client.arenas.arenas ]
+
+		client.journal.open()
+		client.launchQuake()
+		client.spool.start()
+		try:
+			elapsed, timings = playGenerations(client, generations)
+		finally:
+			client.arenas.kill()
+			client.spool.stop(30.0)
+			client.journal.close()
+
+		trips, pipelined = measureRpc(root)
+	finally:
+		server.stop()
+		shutil.rmtree(root, ignore_errors=True)
+
+	lines = sum([ meter.lines for meter in meters ])
+	busy = sum([ meter.busy for meter in meters ])
+	matchTime = sum(timings['match'])
+	posted = len(server.results)
+	report = {
+		'generations':generations,
+		'posted':posted,
+		'bots':bots,
+		'generationsPerHour':generations * 3600.0 / elapsed,
+		'stages':dict([ (stage, {'mean':sum(values) / max(1, len(values)), 'max':max(values or [0.0])})
+						for stage, values in timings.iteritems() ]),
+		'consoleLines':lines,
+		'consoleLinesPerSecond':matchTime and lines / matchTime or 0.0,
+		'consoleLinesPerBusySecond':busy and lines / busy or 0.0,
+		'rpcRoundTrip':{'mean':sum(trips) / len(trips), 'p50':percentile(trips, 0.5), 'p99':percentile(trips, 0.99)},
+		'rpcPipelinedPerSecond':pipelined,
+	}
+
+	print
+	print '%-28s %10.1f (%d of %d posted)' % ('generations/hour', report['generationsPerHour'], posted, generations)
+	for stage in STAGES + [ 'connect' ]:
+		print '%-28s %10.3f s mean %10.3f s max' % (stage, report['stages'][stage]['mean'], report['stages'][stage]['max'])
+	print '%-28s %10.1f (%d lines)' % ('console lines/s delivered', report['consoleLinesPerSecond'], lines)
+	print '%-28s %10.1f' % ('console lines/s handled', report['consoleLinesPerBusySecond'])
+	print '%-28s %10.3f ms mean %7.3f ms p50 %7.3f ms p99' % ('rpc round trip',
+			1000 * report['rpcRoundTrip']['mean'], 1000 * report['rpcRoundTrip']['p50'], 1000 * report['rpcRoundTrip']['p99'])
+	print '%-28s %10.1f' % ('rpc replies/s pipelined', report['rpcPipelinedPerSecond'])
+
+	if reportPath:
+		fp = open(reportPath, 'w')
+		json.dump(report, fp, indent=2, sort_keys=True)
+		fp.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+"""
+Measures the replies per second taken from a chatty bot: bench/fakeBot.py
+printing FAKE_BOT_NOISE lines of chatter before each 'return ...' reply.
+The same stream is read with asyncPipe.LineReader and by reading each burst
+into a new string and splitting it, as the RPC engine used to, and then
+through the RPC engine itself with every command in flight at once.
+
+	python bench/rpcBench.py [commands] [noise lines per reply]
+"""
+import os
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import asyncPipe
+from bot import Bot
+
+READ_SIZE = 4096
+
+def launch(count):
+	"Starts a fake bot and feeds it count commands and a quit from a thread"
+
+	proc = asyncPipe.Popen([sys.executable, os.path.join(BENCH_DIR, 'fakeBot.py'), 'rpcbench'],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+	def feed():
+		for i in range(count):
+			proc.stdin.write('ping %d\n' % i)
+		proc.stdin.write('quit\n')
+		proc.stdin.flush()
+
+	thread = threading.Thread(target=feed)
+	thread.setDaemon(True)
+	thread.start()
+	return proc
+
+def splitting(proc):
+	"Reads the way the RPC engine used to and returns the replies seen"
+
+	fd = proc.stdout.fileno()
+	buffer = ''
+	replies = 0
+	while True:
+		select.select([fd], [], [])
+		data = os.read(fd, READ_SIZE)
+		if not data:
+			return replies
+
+		lines = (buffer + data).split('\n')
+		buffer = lines.pop()
+		for line in lines:
+			if line.startswith('return '):
+				replies = replies + 1
+
+def lineReader(proc):
+	"Reads with a LineReader and returns the replies seen"
+
+	fd = proc.stdout.fileno()
+	reader = proc.lineReader()
+	replies = 0
+	while True:
+		select.select([fd], [], [])
+		lines = reader.read()
+		if lines is None:
+			return replies
+
+		for line in lines:
+			if line.startswith('return '):
+				replies = replies + 1
+
+def measure(read, count):
+
+	proc = launch(count)
+	started = time.time()
+	replies = read(proc)
+	elapsed = time.time() - started
+	proc.wait()
+
+	if replies != count + 1:
+		raise SystemError('%s saw %d of %d replies' % (read.__name__, replies, count + 1))
+	return replies / elapsed
+
+def engine(count):
+	"Replies per second through the RPC engine with every command in flight"
+
+	root = tempfile.mkdtemp(prefix='rpcBench')
+	try:
+		exe = os.path.join(root, 'rpcbot')
+		shutil.copy(os.path.join(BENCH_DIR, 'fakeBot.py'), exe)
+		bot = Bot('rpcbot')
+		bot.exe = exe
+		bot.launch()
+		try:
+			started = time.time()
+			futures = [ bot.callAsync('ping %d' % i) for i in range(count) ]
+			for future in futures:
+				future.result(60.0)
+			return count / (time.time() - started)
+		finally:
+			bot.callAsync('quit').result(5.0)
+	finally:
+		shutil.rmtree(root, ignore_errors=True)
+
+def main():
+
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+	noise = len(sys.argv) > 2 and sys.argv[2] or '10'
+	os.environ['FAKE_BOT_NOISE'] = noise
+
+	print '%d replies, %s lines of chatter before each' % (count, noise)
+	for read in (splitting, lineReader):
+		print '%-28s %10.1f replies/s' % (read.__name__, measure(read, count))
+	print '%-28s %10.1f replies/s' % ('rpc engine', engine(count))
+
+if __name__ == '__main__':
+	main()
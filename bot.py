@@ -1,21 +1,111 @@
+from __future__ import with_statement
+import array
 import asyncPipe
+import fitness
+import metrics
 import os
 import random
 import re
+import rpc
 import subprocess
-import threading
-import Queue
 import logging
 
+PROXY_CALL_TIMEOUT = 30.0
+
+def command(methodName, *args):
+	"The line sent to a bot to invoke methodName(*args)"
+	
+	return '%s %s' % (methodName, ' '.join(map(lambda s: str(s), args)))
+
+class Scoreboard(object):
+	"""
+	The counters of every bot in a generation, held in parallel arrays and
+	indexed by the position at which each bot was added. Bot.stats is a view
+	onto one slot.
+	"""
+	
+	COUNTERS = ('frags', 'suicides', 'deaths')
+	
+	def __init__(self):
+		self.names = []
+		self.index = {}
+		for counter in self.COUNTERS:
+			setattr(self, counter, array.array('l'))
+	
+	def __len__(self):
+		return len(self.names)
+	
+	def add(self, name):
+		
+		self.index[name] = len(self.names)
+		self.names.append(name)
+		for counter in self.COUNTERS:
+			getattr(self, counter).append(0)
+		
+		return Stats(self, len(self.names) - 1)
+	
+	def stats(self, name):
+		return Stats(self, self.index[name])
+	
+	def replay(self, log, start=0):
+		"""
+		Adds the frags and deaths recorded in an eventLog.EventLog from event
+		start onwards, and returns the index of the event after the last one
+		added. Bots in the log that aren't on the board are added to it.
+		"""
+		
+		ids = []
+		for name in log.names:
+			if name not in self.index:
+				self.add(name)
+			ids.append(self.index[name])
+		
+		end = len(log)
+		for attacker, victim in zip(log.attackers[start:end], log.victims[start:end]):
+			if attacker < 0:
+				self.suicides[ids[victim]] += 1
+			else:
+				self.frags[ids[attacker]] += 1
+				self.deaths[ids[victim]] += 1
+		
+		return end
+	
+	@classmethod
+	def fromLogs(cls, logs):
+		"Recomputes the counters of a generation from the event logs of its matches"
+		
+		board = cls()
+		for log in logs:
+			board.replay(log)
+		return board
+
+def counter(name):
+	"A Stats attribute backed by the named array of its Scoreboard"
+	
+	def get(self):
+		return getattr(self.board, name)[self.slot]
+	def set(self, value):
+		getattr(self.board, name)[self.slot] = value
+	return property(get, set)
+
 class Stats(object):
    
-	def __init__(self):
-		self.frags = 0
-		self.suicides = 0
-		self.deaths = 0
+	__slots__ = ('board', 'slot')
+	
+	def __init__(self, board=None, slot=None):
+		if board is None:
+			board = Scoreboard()
+			slot = board.add(None).slot
+		self.board = board
+		self.slot = slot
+	
+	frags = counter('frags')
+	suicides = counter('suicides')
+	deaths = counter('deaths')
    
 	def update(self,dict):
-		self.__dict__.update(dict)
+		for name, value in dict.iteritems():
+			setattr(self, name, value)
 
 	def deathFactor(self):
 		return (self.deaths + self.suicides) / (1.0 + self.deaths + self.suicides + self.frags) 
@@ -24,22 +114,29 @@ class Stats(object):
 		return self.suicides / (1.0 + self.suicides + self.frags)
 
 	def computeFitness(self):
-		return (1.0 + self.frags)*(1.0 - self.deathFactor())*(1.0 - self.suicideFactor())
+		return fitness.default(self.frags, self.deaths, self.suicides)
 
 
 class Bot(object):
 	"A bot received from the GP server system"
 
-	def __init__(self, name, code):
+	def __init__(self, name, scoreboard=None, srcFile=None, digest=None):
 		self.logf = logging.getLogger('Bot.%s' % name)
 		self.name = name
-		self.code = code
-		self.stats = Stats()
+		if scoreboard is None:
+			scoreboard = Scoreboard()
+		self.stats = scoreboard.add(name)
+
+		# The source is kept in the workspace, never in memory
+		self.srcFile = srcFile
+		self.digest = digest
 
 		self.exe = None
 		self.baseDir = None
+		self.cacheKey = None
 		self.marshalling = False
-		self.marshalingThread = None
+		self.channel = None
+		self.proc = None
 
 	def __getattr__(self,methodName):
 
@@ -51,25 +148,29 @@ class Bot(object):
 		if not re.match('__[a-zA-Z_][a-zA-Z0-9_]*__', methodName):
 			def proxy(*args):
 				
-				cmdString = '%s %s' % (methodName, ' '.join(map(lambda s: str(s), args)))
-				return self.proxyCall(cmdString)
+				return self.proxyCall(command(methodName, *args))
 			return proxy
 			
 		raise AttributeError, methodName
 
 	def proxyCall(self,cmdString):
 		
-		self.callQueue.put(cmdString)
 		try:
-			result = self.returnQueue.get(timeout = 30.0)
-			return result
-		except Queue.Empty:
-			self.logf.debug('%s command  timed out' % cmdString)
-			raise SystemError
+			return self.callAsync(cmdString).result(timeout = PROXY_CALL_TIMEOUT)
+		except rpc.RpcTimeout:
+			self.logf.debug('%s command  timed out', cmdString)
+			raise
+	
+	def callAsync(self,cmdString):
+		"""
+		Sends a command without waiting for the reply; returns an rpc.Future.
+		"""
+		return rpc.engine.call(self.channel, cmdString)
 	 
+	@metrics.timed('q2gp_bot_launch_seconds', 'Time to start a bot process')
 	def launch(self):
 
-		self.logf.debug('Ready to launch: cwd = %s, args = %s' % (os.path.dirname(self.exe), str([self.exe, self.name])))
+		self.logf.debug('Ready to launch: cwd = %s, args = %s', os.path.dirname(self.exe), [self.exe, self.name])
 
 		# Open the process and redirect stdout, stderr to the bot's log file
 		self.proc = asyncPipe.Popen(args=[self.exe, self.name], 
@@ -77,64 +178,20 @@ class Bot(object):
 								stdout=subprocess.PIPE,
 								stdin=subprocess.PIPE,
 								cwd=os.path.dirname(self.exe))
-		self.callQueue = Queue.Queue(1)
-		self.returnQueue = Queue.Queue(1)
 
 		self.logf.debug('Launched bot: %s with pid = %d', self.name, self.proc.pid)
 
-		self.logf.debug('Starting marshalling thread')
-		self.marshalingThread = threading.Thread(name='%s:marshalLoop' % self.name,
-												 target=self.marshalLoop)
-		self.marshalingThread.start()
-
-		# Wait for notification that the marshalling thread is ready
-		self.logf.debug('Waiting for marshalling thread to become ready')
-		self.returnQueue.get()
-		self.logf.debug('Marshalling thread is ready to handle calls')
+		# Commands and replies are handled by the shared RPC engine
+		self.channel = rpc.engine.register(self, self.proc)
+		self.marshalling = True
 		
 		return self.proc.pid
 	
-	def marshalLoop(self):
-		
-		try:
-			self.marshalling = True
-	
-			# Send notification that we are ready to go
-			self.returnQueue.put('ready')
-			while self.proc.poll() == None:
-	
-				try:
-					# Get a command from the call queue
-					cmdString = self.callQueue.get(block=True,timeout=1.0)
-					self.logf.debug('%s << %s', self.name, cmdString)
-				
-					# Send the cmd to the bot
-					self.proc.stdin.write('%s\n' % cmdString)
-	
-				except Queue.Empty:
-					continue
-				
-				# Wait for a return value
-				self.proc.pollStdout(30000.0)
-				line = self.proc.stdout.readline()
-				
-				# Pull the return value out
-				result = re.match('(return )(.*)(\\n)', line).group(2)
-				self.logf.debug('%s >> %s', self.name, result)
-				self.returnQueue.put(result)
-	
-			# Cleanup
-			self.marshalling = False
-			self.marshalingThread = None
-	
-			self.proc.wait()
-			self.proc.stdin.close()
-			self.proc.stdout.close()
-			self.proc = None
-		except:
-			if self.proc:
-				asyncPipe.processList.killPid(self.proc.pid)
-			
+	def exited(self, returncode):
+		"""
+		Called by the RPC engine once the bot's process has gone away.
+		"""
+		self.marshalling = False
+		self.proc = None
 		
-		self.logf.debug('Marshalling thread is done.')
-
+		self.logf.debug('%s %s', self.name, asyncPipe.exitReason(returncode))
@@ -1,7 +1,84 @@
 import atexit
+import glob
+import hashlib
 import logging
 import os
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+import traceback
+
+from Queue import PriorityQueue
+
+import metrics
+
+from buildCache import BuildCache
+
+PREBUILT_LIB = 'q2botcore-prebuilt'
+
+# Libraries in the library paths whose contents are part of every cache key
+LIB_PATTERNS = ['lib*.a', 'lib*.so', 'lib*.so.*', 'lib*.dylib']
+
+# Write buffer for bot sources as they are received
+SOURCE_BUFFER = 65536
+
+COMPILE_SECONDS = metrics.histogram('q2gp_compile_seconds', 'Time to compile and link one bot')
+COMPILE_FAILURES = metrics.counter('q2gp_compile_failures_total', 'Bots that failed to build')
+CACHE_HITS = metrics.counter('q2gp_build_cache_hits_total', 'Bots reused from the build cache')
+CACHE_MISSES = metrics.counter('q2gp_build_cache_misses_total', 'Bots not found in the build cache')
+
+def cpuCount():
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except (ImportError, NotImplementedError):
+		return 1
+
+class BuildResult(object):
+	"The outcome of compiling a single bot"
+
+	def __init__(self, bot, status, stderr, elapsed, cached=False):
+		self.bot = bot
+		self.status = status
+		self.stderr = stderr
+		self.elapsed = elapsed
+		self.cached = cached
+
+	def ok(self):
+		return self.status == 0
+
+class SourceFile(object):
+	"""
+	A bot's source, written to the workspace through a buffer as it arrives
+	and hashed on the way so that it never has to be read back or held in
+	memory.
+	"""
+
+	def __init__(self, path):
+
+		directory = os.path.dirname(path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+		self.path = path
+		self.fp = open(path, 'w', SOURCE_BUFFER)
+		self.hash = hashlib.sha1()
+		self.lines = 0
+
+	def write(self, data):
+
+		self.fp.write(data)
+		self.hash.update(data)
+		self.lines = self.lines + 1
+
+	def close(self):
+		"Finishes the file and returns the digest of its contents"
+
+		self.fp.close()
+		return self.hash.hexdigest()
 
 class Builder(object):
 
@@ -13,6 +90,15 @@ class Builder(object):
 		self.pathToBotcore = config['path.q2botcore']
 		self.workingDir = os.path.abspath(config['path.workspace'])
 
+		# Each generation's sources and executables can be kept in a RAM
+		# backed directory, one per workspace so that clients sharing it
+		# don't collide and a restarted client finds its generations again
+		self.scratchDir = self.workingDir
+		if config.get('path.scratch'):
+			self.scratchDir = os.path.join(os.path.abspath(config['path.scratch']),
+					'q2gp-' + BuildCache.key(self.workingDir)[:12])
+		self.stdin = config.get('build.stdin')
+
 		self.cflags = config['build.cflags']
 		self.ldflags = config['build.ldflags']
 		
@@ -21,13 +107,177 @@ class Builder(object):
 		self.libs = config['build.libs']
 		self.srcFiles = map(lambda x: self.pathToBotcore + '/' + x, config['q2botcore.src'])
 		
+		self.pathToAr = config.get('path.ar', 'ar')
+		self.pch = config.get('build.pch')
+		self.coreDir = None
+		self.coreDigest = None
+
+		self.jobs = config.get('build.jobs') or cpuCount()
+		self.toolchainDigest = BuildCache.key(self.compilerVersion(), self.cflags, self.ldflags, self.libs)
+
+		self.cache = None
+		if config.get('path.cache'):
+			self.cache = BuildCache(config['path.cache'], config.get('build.cache.size'))
+
+	def compilerVersion(self):
+
+		proc = subprocess.Popen([self.pathToGpp, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		out, _ = proc.communicate()
+		return out
+
+	def digestBotcore(self):
+		"""
+		Digest of the q2botcore sources and headers that every bot is built
+		against, and of the libraries in the library paths it is linked with.
+		"""
+
+		files = list(self.srcFiles)
+		files.extend(sorted(glob.glob(self.pathToBotcore + '/*.h')))
+		for libDir in self.libPaths:
+			for pattern in LIB_PATTERNS:
+				files.extend(sorted(glob.glob(libDir + '/' + pattern)))
+
+		parts = []
+		for path in files:
+			fp = open(path, 'rb')
+			parts.append(path)
+			parts.append(fp.read())
+			fp.close()
+
+		return BuildCache.key(*parts)
+
+	def run(self, args, stdin=None):
+		"""
+		Runs args and returns its exit status and output, feeding it the file
+		at stdin if one is given.
+		"""
+
+		self.logf.debug(' '.join(args))
+
+		input = stdin and open(stdin, 'rb')
+		try:
+			proc = subprocess.Popen(args, stdin=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			out, err = proc.communicate()
+		finally:
+			if input:
+				input.close()
+		return proc.returncode, out + err
+
+	def prepare(self):
+		"""
+		Prebuilds the q2botcore sources into a static library, and the
+		build.pch header into a precompiled header, so that each bot build
+		only has to compile its own source. The results are kept in a
+		directory named after the digest of their inputs, so they are rebuilt
+		whenever the sources, headers or flags change.
+		"""
+
+		coreDigest = BuildCache.key(self.toolchainDigest, self.digestBotcore())
+		if coreDigest == self.coreDigest:
+			return
+
+		self.coreDigest = coreDigest
+		self.coreDir = None
+		if not self.srcFiles and not self.pch:
+			return
+
+		coreDir = self.workingDir + '/.botcore/' + coreDigest
+		if not os.path.exists(coreDir) and not self.buildBotcore(coreDir):
+			self.logf.warning('Failed to prebuild q2botcore, bots will be built from source')
+			return
+
+		self.coreDir = coreDir
+
+	def buildBotcore(self, coreDir):
+
+		self.logf.info('Prebuilding q2botcore into %s', coreDir)
+
+		parentDir = os.path.dirname(coreDir)
+		if not os.path.exists(parentDir):
+			os.makedirs(parentDir)
+
+		# Build in a scratch directory and move it into place when complete
+		tmpDir = tempfile.mkdtemp(prefix='.tmp', dir=parentDir)
+		try:
+			args = [self.pathToGpp]
+			for includeDir in self.includePaths:
+				args.append("-I" + includeDir)
+			if self.cflags:
+				map(args.append, self.cflags.split())
+
+			if self.pch:
+				header = self.pathToBotcore + '/' + self.pch
+				status, output = self.run(args + ['-x', 'c++-header', header,
+								'-o', tmpDir + '/' + self.pch + '.gch'])
+				if status != 0:
+					self.logf.error('Failed to precompile %s:\n%s', header, output.rstrip())
+					return False
+
+			objects = []
+			for src in self.srcFiles:
+				obj = tmpDir + '/' + os.path.splitext(os.path.basename(src))[0] + '.o'
+				status, output = self.run(args + ['-c', src, '-o', obj])
+				if status != 0:
+					self.logf.error('Failed to compile %s:\n%s', src, output.rstrip())
+					return False
+				objects.append(obj)
+
+			if objects:
+				status, output = self.run([self.pathToAr, 'rcs', tmpDir + '/lib' + PREBUILT_LIB + '.a'] + objects)
+				if status != 0:
+					self.logf.error('Failed to archive q2botcore:\n%s', output.rstrip())
+					return False
+
+			# Anything built from older sources is stale now
+			for stale in os.listdir(parentDir):
+				if not stale.startswith('.'):
+					shutil.rmtree(parentDir + '/' + stale, ignore_errors=True)
+
+			os.rename(tmpDir, coreDir)
+			return True
+
+		finally:
+			if os.path.exists(tmpDir):
+				shutil.rmtree(tmpDir, ignore_errors=True)
+
+	def cacheKey(self, bot):
+		return BuildCache.key(self.toolchainDigest, self.coreDigest, bot.digest)
+
+	def workDirFor(self, subdir=None):
+
+		if subdir:
+			return self.scratchDir + '/' + subdir
+		return self.scratchDir
+
+	def openSource(self, name, workDir=None):
+		"""
+		Returns a SourceFile for bot name at the place build() expects it.
+		"""
+		return SourceFile((workDir or self.scratchDir) + '/' + name + '/' + name + '.cpp')
+
 	def compile(self, bot):
+
+		self.prepare()
+		return self.build(bot).status
+
+	def build(self, bot, workDir=None):
+		"""
+		Compiles a single bot in its own directory under workDir (by default
+		the scratch directory) and returns a BuildResult holding the compiler's exit
+		status, its diagnostics and the time taken.
+		"""
 		
-		# Construct the command line
+		# Construct the command line, the prebuilt core comes first so that
+		# its precompiled header is found before the plain one
 		args = [self.pathToGpp]
+		coreDir = self.coreDir
+		if coreDir:
+			args.append("-I" + coreDir)
 		for includeDir in self.includePaths:
 			args.append("-I" + includeDir)
 
+		if coreDir:
+			args.append("-L" + coreDir)
 		for libDir in self.libPaths:
 			args.append("-L" + libDir)
 
@@ -37,47 +287,147 @@ class Builder(object):
 		if self.ldflags:
 			map(args.append, self.ldflags.split())
 		
-		# Create the source file
-		botDir = self.workingDir + '/' + bot.name
-		codePath = botDir + '/' + bot.name + '.cpp'
+		# The source was written to the workspace as it was received
+		botDir = (workDir or self.scratchDir) + '/' + bot.name
+		codePath = bot.srcFile
 		outputPath = botDir + '/runbot'
 
 		if not os.path.exists(botDir):
 			os.makedirs(botDir)
-		fp = open(codePath, 'w')
-		fp.write(bot.code)
-		fp.close()
+
+		# An identical bot has been built before, reuse it
+		started = time.time()
+		if self.cache:
+			bot.cacheKey = self.cacheKey(bot)
+			if self.cache.fetch(bot.cacheKey, outputPath):
+				CACHE_HITS.inc()
+				self.logf.debug('Cache hit for %s (%s)', bot.name, bot.cacheKey)
+				bot.baseDir = botDir
+				bot.exe = outputPath
+
+				return BuildResult(bot, 0, '', time.time() - started, cached=True)
+			CACHE_MISSES.inc()
 		
 		# Specify output
 		args.append("-o")
 		args.append(outputPath)
 
 		# Source files
-		for file in self.srcFiles:
-			args.append(file)
-		args.append(codePath)
+		if not (coreDir and self.srcFiles):
+			for file in self.srcFiles:
+				args.append(file)
+		if self.stdin:
+			args.extend(['-x', 'c++', '-', '-x', 'none'])
+		else:
+			args.append(codePath)
 		
 		# This option has to go at the end so that ld picks it up
+		if coreDir and self.srcFiles:
+			args.append("-l" + PREBUILT_LIB)
 		for lib in self.libs:
 			args.append("-l" + lib)
 		
-		self.logf.debug(' '.join(args))
-		
 		# Run the command
-		result = os.spawnv(os.P_WAIT, self.pathToGpp, args)
-		if result == 0:
+		status, output = self.run(args, self.stdin and codePath)
+		result = BuildResult(bot, status, output, time.time() - started)
+		COMPILE_SECONDS.observe(result.elapsed)
+
+		if result.ok():
 			bot.baseDir = botDir
 			bot.exe = outputPath
-			bot.srcFile = codePath
 
-			return 0
+			if self.cache:
+				self.cache.store(bot.cacheKey, outputPath)
 
+			return result
+
+		COMPILE_FAILURES.inc()
 		self.logf.warning('Failed to build %s', codePath)
 		return result
 
-	def clean(self,bot):
-		
-		self.logf.info('Cleaning up %s', bot.name)
+	def startPool(self, subdir=None):
+		"""
+		Returns a running CompilePool that builds bots as they are submitted,
+		optionally in a subdirectory of the scratch directory.
+		"""
+		self.prepare()
+
+		pool = CompilePool(self, self.jobs, self.workDirFor(subdir))
+		pool.start()
+		return pool
+
+	def clean(self, subdir):
+		"""
+		Removes a generation's directory, with the sources and executables
+		of all its bots, in one go.
+		"""
 		
-		os.remove(bot.srcFile)
-		os.remove(bot.exe)
+		workDir = self.workDirFor(subdir)
+		self.logf.info('Cleaning up %s', workDir)
+		shutil.rmtree(workDir, ignore_errors=True)
+
+class CompilePool(object):
+	"""
+	A bounded pool of threads that run the compiler concurrently. Queued bots
+	are built largest source first so that the long compiles don't end up
+	trailing at the end of the batch. A bot that fails to build is recorded
+	in its BuildResult and doesn't affect the rest of the batch.
+	"""
+
+	def __init__(self, builder, jobs, workDir=None):
+
+		self.logf = logging.getLogger('Builder')
+		self.builder = builder
+		self.workDir = workDir
+		self.queue = PriorityQueue()
+		self.mutex = threading.Lock()
+		self.results = []
+		self.sequence = 0
+
+		self.workers = []
+		for i in range(max(1, jobs)):
+			worker = threading.Thread(name='CompilePool:%d' % i, target=self.work)
+			worker.setDaemon(True)
+			self.workers.append(worker)
+
+	def start(self):
+
+		for worker in self.workers:
+			worker.start()
+
+	def submit(self, bot):
+
+		with self.mutex:
+			self.sequence = self.sequence + 1
+			self.queue.put((-os.path.getsize(bot.srcFile), self.sequence, bot))
+
+	def join(self):
+		"""
+		Waits for all submitted bots to finish building and returns their
+		BuildResults in order of completion.
+		"""
+
+		# The sentinels sort after any real work still in the queue
+		for worker in self.workers:
+			self.queue.put((sys.maxint, sys.maxint, None))
+		for worker in self.workers:
+			worker.join()
+
+		return self.results
+
+	def work(self):
+
+		while True:
+			_, _, bot = self.queue.get()
+			if bot is None:
+				return
+
+			started = time.time()
+			try:
+				result = self.builder.build(bot, self.workDir)
+			except:
+				self.logf.error('Exception while building %s', bot.name, exc_info=True)
+				result = BuildResult(bot, -1, traceback.format_exc(), time.time() - started)
+
+			with self.mutex:
+				self.results.append(result)
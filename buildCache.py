@@ -0,0 +1,145 @@
+from __future__ import with_statement
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+class BuildCache(object):
+	"""
+	A persistent store of compiled bots keyed by a digest of everything that
+	went into the build. Entries are published with an atomic rename and
+	evicted least recently used first once the cache grows beyond maxSize
+	bytes, so several clients can safely share one cache directory.
+	"""
+
+	def __init__(self, path, maxSize):
+
+		self.logf = logging.getLogger('BuildCache')
+
+		self.path = os.path.abspath(path)
+		self.maxSize = maxSize
+		self.lockPath = self.path + os.sep + '.lock'
+
+		self.mutex = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		if not os.path.exists(self.path):
+			try:
+				os.makedirs(self.path)
+			except OSError, why:
+				if why[0] != errno.EEXIST:
+					raise
+
+	@staticmethod
+	def key(*parts):
+
+		digest = hashlib.sha1()
+		for part in parts:
+			digest.update(str(part))
+			digest.update('\0')
+
+		return digest.hexdigest()
+
+	def entryPath(self, key):
+		return self.path + os.sep + key
+
+	def fetch(self, key, dest):
+		"""
+		Places the cached executable for key at dest. Returns False on a miss.
+		"""
+
+		entry = self.entryPath(key)
+		try:
+			# Refresh the entry so that eviction sees it as recently used
+			os.utime(entry, None)
+			if os.path.exists(dest):
+				os.remove(dest)
+			try:
+				os.link(entry, dest)
+			except OSError, why:
+				if why[0] not in (errno.EXDEV, errno.EPERM):
+					raise
+				shutil.copy2(entry, dest)
+
+		except (IOError, OSError), why:
+			if why[0] != errno.ENOENT:
+				raise
+
+			# Either never built, or evicted by another client under our feet
+			with self.mutex:
+				self.misses = self.misses + 1
+			return False
+
+		with self.mutex:
+			self.hits = self.hits + 1
+		return True
+
+	def store(self, key, src):
+		"""
+		Copies a freshly built executable into the cache.
+		"""
+
+		fd, tmpPath = tempfile.mkstemp(prefix='.tmp', dir=self.path)
+		try:
+			with os.fdopen(fd, 'wb') as tmp:
+				with open(src, 'rb') as fp:
+					shutil.copyfileobj(fp, tmp)
+			shutil.copymode(src, tmpPath)
+
+			# Readers only ever see complete entries
+			os.rename(tmpPath, self.entryPath(key))
+		except:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
+		self.evict()
+
+	def evict(self):
+		"""
+		Removes the least recently used entries until the cache fits in
+		maxSize. Eviction is serialised across processes with a lock file.
+		"""
+
+		if not self.maxSize:
+			return
+
+		with open(self.lockPath, 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				entries = []
+				total = 0
+				for name in os.listdir(self.path):
+					if name.startswith('.'):
+						continue
+					try:
+						st = os.stat(self.entryPath(name))
+					except OSError:
+						continue
+					entries.append((st.st_mtime, st.st_size, name))
+					total = total + st.st_size
+
+				entries.sort()
+				for mtime, size, name in entries:
+					if total <= self.maxSize:
+						break
+					try:
+						os.remove(self.entryPath(name))
+					except OSError:
+						continue
+					total = total - size
+					with self.mutex:
+						self.evictions = self.evictions + 1
+					self.logf.debug('Evicted %s (%d bytes)', name, size)
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def summary(self):
+		with self.mutex:
+			return 'hits = %d, misses = %d, evictions = %d' % (self.hits, self.misses, self.evictions)
@@ -1,33 +1,74 @@
 import logging
+import os
 import platform
 import socket
 import sys
+import threading
 import time
+import asyncLog
 import asyncPipe
+import metrics
 
 import quake2
 
-from bot import Bot
+from Queue import Queue
+
+from arena import ArenaPool
+from bot import Bot, Scoreboard
 from build import Builder
+from fitness import Fitness
+from journal import Journal
+from resultsSpool import ResultsSpool
+from tournament import Tournament
 
 MAX_BOTS = 16
 SERVER_RETRY_TIMEOUT = 30.0
 
+STAGE_SECONDS = 'q2gp_stage_seconds'
+
+class Generation(object):
+	"A group of bots received from the GP server under one token"
+	
+	def __init__(self, number):
+		self.number = number
+		self.token = None
+		self.bots = []
+		self.finishers = []
+		self.scoreboard = Scoreboard()
+		
+		# Whether the generation holds one of Main.inFlight's permits
+		self.permit = True
+
 class Main(object):
 
-	def __init__(self):
+	def __init__(self, overrides=None):
 		self.logf = logging.getLogger('Main')
+		self.sourceLog = logging.getLogger('Main.source')
 		
 		self.configPath = 'config/' + platform.system() + '.conf'
-		self.initPlatformConfig()
+		self.initPlatformConfig(overrides)
 		
 		self.builder = Builder(self.config)
-		self.q2ded = quake2.Server(self.config)
+		self.arenas = ArenaPool(self.config)
+		self.tournament = Tournament(self.config, self.arenas, MAX_BOTS)
+		self.maps = self.config.get('quake2.maps') or ['tsm_dm1']
+		self.timelimit = self.config.get('match.timelimit') or 2.0
+		self.fitness = Fitness(self.config)
+		self.exporter = metrics.Exporter(self.config)
+		self.spool = ResultsSpool(self.config)
+		self.journal = Journal(self.config.get('path.journal') or self.config['path.workspace'] + '/journal')
 		#TODO self.quake2 = quake2.Client(self.config)
 		
+		# Generations between being fetched and having their results posted
+		self.prefetch = self.config.get('gp.prefetch') or 0
+		self.inFlight = threading.Semaphore(1 + self.prefetch)
+		self.ready = Queue()
+		self.resumed = []
+		self.generationCount = 0
+		
 		self.running = True
 	
-	def initPlatformConfig(self):
+	def initPlatformConfig(self, overrides=None):
 	
 		# Load the configuration dictionary
 		try:
@@ -43,6 +84,9 @@ class Main(object):
 			# Now load the platform config to override defaults where necessary
 			fp = open(self.configPath)
 			self.config.update(eval(''.join(fp.readlines())))
+			if overrides:
+				self.config.update(overrides)
+			asyncLog.configure(self.config)
 
 			# Log the platform configuration info
 			self.logf.info('Platform config:')
@@ -58,7 +102,7 @@ class Main(object):
 				fp.close()
 	
 	def launchQuake(self):
-		self.q2ded.launch({
+		self.arenas.launch({
 				'timelimit':0,
 				'fraglimit':0,
 				'maxclients':MAX_BOTS+1,	# +1 for a spectator
@@ -66,46 +110,172 @@ class Main(object):
 						+ quake2.DmFlags.FORCE_RESPAWN		# Bots that aren't firing should come back if they die
 						+ quake2.DmFlags.SPAWN_FARTHEST		# This prevents telefrags
 			},
-			'tsm_dm1')
+			self.maps[0])
 		
 	def run(self):
 			
 		# Launch the quake2 dedicated server	
 		self.launchQuake()
+		self.exporter.start()
+		self.spool.start()
+		
+		# Finish whatever was in flight when we last stopped
+		self.resume()
 		
 		gameCount = 0
 		
+		# Fetch and build upcoming generations while the current one plays
+		if self.prefetch:
+			fetcher = threading.Thread(name='GenerationFetcher', target=self.fetchLoop)
+			fetcher.setDaemon(True)
+			fetcher.start()
+		
 		# Keep polling the server for 
 		while self.running:
 			
 			self.logf.info('Starting a new game. gameCount = %d', gameCount)
-			token = self.getBots()
+			generation = self.nextGeneration()
 			
-			if token:
-				self.compileBots()
+			if generation:
 				try:
-					self.runGame()
+					# Rotate maps in the running servers
+					if len(self.maps) > 1:
+						self.arenas.changeMap(self.maps[gameCount % len(self.maps)])
+					
+					self.runGame(generation)
 				except:
-					self.logf.error('Error encountered, results discarded, resetting')
+					self.logf.error('Error encountered, results discarded, resetting', exc_info=True)
+					self.journal.append('discarded', generation.number)
 					asyncPipe.processList.cleanupProcesses()
-					self.q2ded.kill()
-					self.launchQuake()
+					self.arenas.resetAll()
 				else:
-					self.postResults(token)
-					self.cleanUp()
-				
+					self.postResults(generation)
 					gameCount = gameCount + 1
-			else:
+				finally:
+					self.cleanUp(generation)
+					if generation.permit:
+						self.inFlight.release()
+			elif not self.prefetch:
 				self.logf.warning('No bots received from server, trying again in %d s', SERVER_RETRY_TIMEOUT)
 				time.sleep(SERVER_RETRY_TIMEOUT)
 
 		# Stop the server
-		self.q2ded.kill()
+		self.arenas.kill()
+		self.spool.stop(SERVER_RETRY_TIMEOUT)
+		self.exporter.stop()
+		self.journal.close()
 	
-	def getBots(self):
+	def resume(self):
+		"""
+		Picks up the generations the journal shows were in flight when the
+		client last stopped. Played generations have their results spooled
+		again; generations that were received in full are rebuilt where their
+		executables are gone and played next. Partly received ones are
+		dropped, the GP server will reissue their work.
+		
+		Generations to be replayed take their in-flight permits here, before
+		the fetcher starts, so that prefetching counts them against the same
+		bound; any beyond it are played without one.
+		"""
+		
+		for record in self.journal.open():
+			self.generationCount = max(self.generationCount, record.number)
+			generation = Generation(record.number)
+			generation.token = record.token
+			
+			if record.results is not None:
+				self.logf.info('Resuming generation %d: posting the results of %d bots', record.number, len(record.results))
+				for name, frags, deaths, suicides in record.results:
+					bot = Bot(name, generation.scoreboard)
+					bot.stats.update({'frags':frags, 'deaths':deaths, 'suicides':suicides})
+					generation.finishers.append(bot)
+				self.postResults(generation)
+				self.cleanUp(generation)
+			
+			elif record.fetched:
+				self.logf.info('Resuming generation %d: replaying its match with %d bots', record.number, len(record.bots))
+				pool = self.builder.startPool('gen%d' % record.number)
+				for name, srcFile, digest in record.bots:
+					bot = Bot(name, generation.scoreboard, srcFile, digest)
+					
+					exe = record.built.get(name)
+					if exe and os.path.exists(exe):
+						bot.exe = exe
+						bot.baseDir = os.path.dirname(exe)
+					elif os.path.exists(srcFile):
+						pool.submit(bot)
+					else:
+						self.logf.warning('\t%s:\tits source is gone, leaving it out', name)
+						continue
+					generation.bots.append(bot)
+				self.compileBots(generation, pool)
+				generation.permit = self.inFlight.acquire(False)
+				self.resumed.append(generation)
+			
+			else:
+				self.logf.info('Dropping generation %d, it was only partly received', record.number)
+				self.journal.append('discarded', record.number)
+				self.cleanUp(generation)
+	
+	def nextGeneration(self):
+		
+		# Resumed generations took their permits in resume()
+		if self.resumed:
+			return self.resumed.pop(0)
+		
+		if self.prefetch:
+			return self.ready.get()
+		
+		self.inFlight.acquire()
+		generation = self.fetchGeneration()
+		if not generation:
+			self.inFlight.release()
+		return generation
+	
+	def fetchLoop(self):
+		"""
+		Keeps up to gp.prefetch generations fetched and built ahead of the
+		one being played.
+		"""
+		while self.running:
+			
+			self.inFlight.acquire()
+			generation = self.fetchGeneration()
+			if generation:
+				self.ready.put(generation)
+			else:
+				self.inFlight.release()
+				self.logf.warning('No bots received from server, trying again in %d s', SERVER_RETRY_TIMEOUT)
+				time.sleep(SERVER_RETRY_TIMEOUT)
+	
+	@metrics.timed(STAGE_SECONDS, 'Time spent in each stage of a generation', stage='fetch')
+	def fetchGeneration(self):
+		"""
+		Retrieves the next generation and compiles its bots as they arrive.
+		Returns None if no bots were received.
+		"""
+		self.generationCount = self.generationCount + 1
+		generation = Generation(self.generationCount)
+		
+		started = time.time()
+		pool = self.builder.startPool('gen%d' % generation.number)
+		token = self.getBots(generation, pool.submit)
+		self.compileBots(generation, pool)
+		self.logf.info('Generation %d fetched and built in %.2f s', generation.number, time.time() - started)
+		
+		if not token:
+			if generation.token:
+				self.journal.append('discarded', generation.number)
+			self.cleanUp(generation)
+			return None
+		
+		return generation
+	
+	def getBots(self, generation, received=None):
 		"""
 		Connect to the q2 bot server (Will) to retrieve the next group of bots
-		to compete. The protocol is simple text as follows:
+		to compete into generation. Each bot is passed to received, if given,
+		as soon as it has been read. The protocol is simple text as follows:
 		
 		1.	CONNECT
 		2.	SEND: GETBOTS\n
@@ -114,7 +284,6 @@ class Main(object):
 		4.	RECV: stmt\n
 		5.	Repeat #4 until: stmt = ENDBOT id\n
 		"""
-		self.bots = []
 		input = None
 		s = socket.socket()
 		try:
@@ -135,20 +304,45 @@ class Main(object):
 				return None
 			
 			self.logf.info('Received token %s', token)
+			generation.token = token
+			self.journal.append('generation', generation.number, token=token)
+			debugSource = self.sourceLog.isEnabledFor(logging.DEBUG)
+			workDir = self.builder.workDirFor('gen%d' % generation.number)
 			for line in input:
 				botName = line.rstrip().split()[1]
-				code = ''
-				for stmt in input:
-					if stmt.startswith('ENDBOT %s' % botName):
-						bot = Bot(botName, code)
-						self.logf.info('Received bot %s\t(%d lines)', botName, len(code.split('\n')))
-						self.bots.append( bot )
-						break
+				endBot = 'ENDBOT %s' % botName
 					
-					# Continue to build the bot
-					self.logf.debug(stmt.rstrip())
-					code = code + stmt
+				# Only the line being received is ever held in memory
+				source = self.builder.openSource(botName, workDir)
+				ended = False
+				try:
+					for stmt in input:
+						if stmt.startswith(endBot):
+							ended = True
+							break
+						
+						if debugSource:
+							self.sourceLog.debug('%s', stmt.rstrip())
+						source.write(stmt)
+				finally:
+					digest = source.close()
+					if not ended:
+						os.remove(source.path)
+				
+				# The stream ended part way through this bot, keep the ones
+				# received in full
+				if not ended:
+					self.logf.warning('Connection closed before ENDBOT %s, generation truncated to %d bots', botName, len(generation.bots))
+					break
+				
+				bot = Bot(botName, generation.scoreboard, source.path, digest)
+				self.journal.append('bot', generation.number, sync=False, name=botName, src=source.path, digest=digest)
+				self.logf.info('Received bot %s\t(%d lines)', botName, source.lines)
+				generation.bots.append( bot )
+				if received:
+					received(bot)
 					
+			self.journal.append('fetched', generation.number)
 			return token
 		
 		except:
@@ -161,51 +355,75 @@ class Main(object):
 		
 		return None
 	
-	def compileBots(self):
-		self.logf.info('Compiling:')
-		for bot in self.bots:
-			self.logf.info('\t%s', bot.name)
-			self.builder.compile(bot)
+	def compileBots(self, generation, pool):
+		self.logf.info('Waiting for %d bots to compile with %d jobs:', len(generation.bots), self.builder.jobs)
+		started = time.time()
+		results = pool.join()
+
+		failed = []
+		for result in results:
+			if result.cached:
+				self.logf.info('\t%s:\tcached', result.bot.name)
+			elif result.ok():
+				self.logf.info('\t%s:\tok (%.2f s)', result.bot.name, result.elapsed)
+			if result.ok():
+				self.journal.append('built', generation.number, sync=False, name=result.bot.name, exe=result.bot.exe)
+			else:
+				self.logf.error('\t%s:\tfailed with status %d (%.2f s)\n%s',
+							result.bot.name, result.status, result.elapsed, result.stderr.rstrip())
+				failed.append(result.bot)
 
-	def cleanUp(self):
-		for bot in self.bots:
-			self.builder.clean(bot)
+		self.journal.commit()
+
+		# Bots that didn't build can't enter the game
+		generation.bots = [ bot for bot in generation.bots if bot not in failed ]
+		self.logf.info('Compiled %d of %d bots, %.2f s after the last one arrived', len(generation.bots), len(results), time.time() - started)
+		if self.builder.cache:
+			self.logf.info('Build cache: %s', self.builder.cache.summary())
+
+	@metrics.timed(STAGE_SECONDS, stage='cleanup')
+	def cleanUp(self, generation):
+		self.builder.clean('gen%d' % generation.number)
 		
-	def runGame(self):
+	@metrics.timed(STAGE_SECONDS, stage='match')
+	def runGame(self, generation):
 		
-		self.q2ded.runGame(2.0, self.bots)
+		# Only bots that completed all of their heats have results to post
+		generation.finishers = self.tournament.run(self.timelimit, generation.bots)
+		self.journal.append('played', generation.number,
+				results=[ [ bot.name, bot.stats.frags, bot.stats.deaths, bot.stats.suicides ] for bot in generation.finishers ])
 	
-	def postResults(self,token):
+	@metrics.timed(STAGE_SECONDS, stage='post')
+	def postResults(self, generation):
 		
-		try:
-			self.logf.info('Posting results to %s:%d with token %s', self.config['gp.host'], self.config['gp.port'], token)
-			s = socket.socket()
-			s.connect((self.config['gp.host'], self.config['gp.port']))
-			s.sendall('POSTRESULTS\n')
-			s.sendall(token + '\n')
-			for bot in self.bots:
-				fitness = bot.stats.computeFitness()
-				self.logf.info('\t%s:\tfitness = %f', bot.name, fitness)
-				s.sendall('%f %s\n' % (fitness, bot.name))
+		"""
+		Spools the generation's results, which are then posted to the GP
+		server in the background until it accepts them.
+		"""
 
-		except:
-			self.logf.warning('Failed to post results to bot server:', exc_info=True)
+		scores = self.fitness.ofBots(generation.finishers)
+		for bot, fitness in zip(generation.finishers, scores):
+			self.logf.info('\t%s:\tfitness = %f', bot.name, fitness)
 
-		finally:
-			if s:
-				s.close()
+		self.spool.add(generation.token, zip(scores, [ bot.name for bot in generation.finishers ]))
+		self.journal.append('spooled', generation.number)
 
 ################################ Main ##########################################
 
-# Set up our logging config
-logging.basicConfig(level=logging.INFO,
-					format='%(asctime)s %(name)6s:%(levelname)-7s %(message)-40s (%(filename)s:%(lineno)s)',
-					filename='GPclient.log',
-					filemode='w')
-console = logging.StreamHandler(sys.stdout)
-console.setLevel(logging.INFO)
-console.setFormatter(logging.Formatter('%(name)8s: %(levelname)-8s %(message)s'))
-logging.getLogger('').addHandler(console)
-
-# Go!
-Main().run()
+if __name__ == '__main__':
+
+	# Set up our logging config
+	logging.basicConfig(level=logging.INFO,
+						format='%(asctime)s %(name)6s:%(levelname)-7s %(message)-40s (%(filename)s:%(lineno)s)',
+						filename='GPclient.log',
+						filemode='w')
+	console = logging.StreamHandler(sys.stdout)
+	console.setLevel(logging.INFO)
+	console.setFormatter(logging.Formatter('%(name)8s: %(levelname)-8s %(message)s'))
+	logging.getLogger('').addHandler(console)
+
+	# Write the log from a background thread
+	asyncLog.install()
+
+	# Go!
+	Main().run()
@@ -0,0 +1,123 @@
+from __future__ import with_statement
+import array
+import struct
+import sys
+import threading
+import time
+
+# File layout, all little-endian:
+#	header		magic, version, start time, name count, cause count, event count
+#	names		(length, bytes) per bot, indexed by the ids below
+#	causes		(length, bytes) per obituary verb phrase
+#	events		float32 seconds since start[n], int16 attacker[n],
+#				int16 victim[n], uint8 cause[n]
+MAGIC = 'Q2EV'
+VERSION = 1
+HEADER = struct.Struct('<4sB3xdHHI')
+LENGTH = struct.Struct('<H')
+
+# Attacker id of a suicide
+NOBODY = -1
+
+# Typecodes of the columns, in file order
+COLUMNS = (('times', 'f'), ('attackers', 'h'), ('victims', 'h'), ('causes', 'B'))
+
+class EventLog(object):
+	"""
+	The frags and deaths of one match, appended as they are parsed from the
+	console. Events are kept column-wise in typed arrays (time, attacker id,
+	victim id, cause id) so a match costs a few bytes per event, and ids
+	index into the names and causes tables.
+	"""
+
+	def __init__(self, names=(), started=None):
+
+		self.started = started or time.time()
+		self.names = list(names)
+		self.ids = dict([ (name, i) for i, name in enumerate(self.names) ])
+		self.causeNames = []
+		self.causeIds = {}
+		self.mutex = threading.Lock()
+
+		for column, typecode in COLUMNS:
+			setattr(self, column, array.array(typecode))
+
+	def __len__(self):
+		return len(self.times)
+
+	def botId(self, name):
+
+		id = self.ids.get(name)
+		if id is None:
+			id = self.ids[name] = len(self.names)
+			self.names.append(name)
+		return id
+
+	def causeId(self, cause):
+
+		id = self.causeIds.get(cause)
+		if id is None:
+			id = self.causeIds[cause] = len(self.causeNames)
+			self.causeNames.append(cause)
+		return id
+
+	def append(self, victim, attacker, cause, when=None):
+		"""
+		Records that victim was killed by attacker, or by itself if attacker
+		is None.
+		"""
+
+		with self.mutex:
+			self.times.append((when or time.time()) - self.started)
+			self.attackers.append(attacker is None and NOBODY or self.botId(attacker))
+			self.victims.append(self.botId(victim))
+			self.causes.append(self.causeId(cause))
+
+	def events(self):
+		"Yields (seconds, attacker, victim, cause), with attacker None for a suicide"
+
+		for t, a, v, c in zip(self.times, self.attackers, self.victims, self.causes):
+			yield t, a != NOBODY and self.names[a] or None, self.names[v], self.causeNames[c]
+
+	def save(self, path):
+
+		with self.mutex:
+			with open(path, 'wb') as fp:
+				fp.write(HEADER.pack(MAGIC, VERSION, self.started, len(self.names), len(self.causeNames), len(self)))
+				for name in self.names:
+					writeString(fp, name)
+				for cause in self.causeNames:
+					writeString(fp, cause)
+				for column, typecode in COLUMNS:
+					values = getattr(self, column)
+					if sys.byteorder != 'little':
+						values = array.array(typecode, values)
+						values.byteswap()
+					values.tofile(fp)
+
+	@classmethod
+	def load(cls, path):
+
+		with open(path, 'rb') as fp:
+			magic, version, started, nameCount, causeCount, count = HEADER.unpack(fp.read(HEADER.size))
+			if magic != MAGIC or version != VERSION:
+				raise IOError('%s is not a version %d event log' % (path, VERSION))
+
+			log = cls([ readString(fp) for i in range(nameCount) ], started)
+			for i in range(causeCount):
+				log.causeId(readString(fp))
+			for column, typecode in COLUMNS:
+				values = getattr(log, column)
+				values.fromfile(fp, count)
+				if sys.byteorder != 'little':
+					values.byteswap()
+
+		return log
+
+def writeString(fp, s):
+	fp.write(LENGTH.pack(len(s)))
+	fp.write(s)
+
+def readString(fp):
+	length, = LENGTH.unpack(fp.read(LENGTH.size))
+	return fp.read(length)
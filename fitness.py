@@ -0,0 +1,99 @@
+"""
+Fitness formulas over whole populations. A formula is written once in
+terms of the frags, deaths and suicides counters and only uses arithmetic,
+so the same function is applied to NumPy arrays in a single vectorised
+pass when NumPy is installed, or row by row to plain numbers otherwise.
+"""
+
+import logging
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+FORMULAS = {}
+
+def formula(name):
+	"Registers a formula under name for the fitness.formula setting"
+
+	def register(fn):
+		FORMULAS[name] = fn
+		return fn
+	return register
+
+@formula('default')
+def default(frags, deaths, suicides):
+	"""
+	Frags, discounted by the share of deaths among everything that happened
+	and by the share of suicides among the bot's own kills.
+	"""
+
+	deathFactor = (deaths + suicides) / (1.0 + deaths + suicides + frags)
+	suicideFactor = suicides / (1.0 + suicides + frags)
+	return (1.0 + frags)*(1.0 - deathFactor)*(1.0 - suicideFactor)
+
+@formula('ratio')
+def ratio(frags, deaths, suicides):
+	"Kills per death, smoothed so that a bot that never died stays finite"
+
+	return (1.0 + frags) / (1.0 + deaths + suicides)
+
+@formula('net')
+def net(frags, deaths, suicides):
+	"Frags less suicides, as on the in-game scoreboard, offset by one"
+
+	return 1.0 + frags - suicides
+
+def lookup(name):
+
+	try:
+		return FORMULAS[name]
+	except KeyError:
+		raise ValueError('Unknown fitness formula: %s' % name)
+
+def compute(frags, deaths, suicides, name='default'):
+	"""
+	Applies the named formula to parallel sequences of counters and returns
+	a list with the fitness of each row.
+	"""
+
+	fn = lookup(name)
+	if numpy is not None:
+		# Counters are small integers, so float64 holds them exactly and the
+		# result matches the scalar arithmetic bit for bit
+		columns = [ numpy.asarray(column, dtype=numpy.float64) for column in (frags, deaths, suicides) ]
+		return fn(*columns).tolist()
+
+	return [ fn(f, d, s) for f, d, s in zip(frags, deaths, suicides) ]
+
+class Fitness(object):
+	"The formula chosen by fitness.formula, applied to bots' counters"
+
+	def __init__(self, config):
+
+		self.logf = logging.getLogger('Fitness')
+		self.name = config.get('fitness.formula') or 'default'
+		self.formula = lookup(self.name)
+
+	def ofStats(self, stats):
+		"Fitness of each of a list of bot.Stats"
+
+		return compute([ s.frags for s in stats ],
+					[ s.deaths for s in stats ],
+					[ s.suicides for s in stats ], self.name)
+
+	def ofBots(self, bots):
+		return self.ofStats([ bot.stats for bot in bots ])
+
+	def ofScoreboard(self, board):
+		"Fitness of every bot on a bot.Scoreboard, in the order they were added"
+
+		return compute(board.frags, board.deaths, board.suicides, self.name)
+
+	def rank(self, bots):
+		"The bots from fittest to least fit, ties broken by name"
+
+		scores = self.ofBots(bots)
+		order = sorted(range(len(bots)), key=lambda i: (-scores[i], bots[i].name))
+		return [ bots[i] for i in order ]
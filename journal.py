@@ -0,0 +1,190 @@
+from __future__ import with_statement
+import json
+import logging
+import os
+import threading
+import zlib
+
+def text(value):
+	"JSON hands strings back as unicode; the rest of the client uses str"
+
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+class GenerationRecord(object):
+	"What the journal knows about one generation"
+
+	def __init__(self, number):
+		self.number = number
+		self.token = None
+		self.bots = []
+		self.fetched = False
+		self.built = {}
+		self.results = None
+		self.done = False
+
+	def apply(self, record):
+
+		op = record['op']
+		if op == 'generation':
+			self.token = text(record['token'])
+		elif op == 'bot':
+			self.bots.append((text(record['name']), text(record['src']), text(record['digest'])))
+		elif op == 'fetched':
+			self.fetched = True
+		elif op == 'built':
+			self.built[text(record['name'])] = text(record['exe'])
+		elif op == 'played':
+			self.results = [ [ text(row[0]) ] + list(row[1:]) for row in record['results'] ]
+		elif op in ('spooled', 'discarded'):
+			self.done = True
+
+	def records(self):
+		"The records that rebuild this state"
+
+		records = [ {'op':'generation', 'generation':self.number, 'token':self.token} ]
+		records.extend([ {'op':'bot', 'generation':self.number, 'name':name, 'src':src, 'digest':digest} for name, src, digest in self.bots ])
+		if self.fetched:
+			records.append({'op':'fetched', 'generation':self.number})
+		records.extend([ {'op':'built', 'generation':self.number, 'name':name, 'exe':exe} for name, exe in self.built.iteritems() ])
+		if self.results is not None:
+			records.append({'op':'played', 'generation':self.number, 'results':self.results})
+		return records
+
+class Journal(object):
+	"""
+	An append-only log of the progress of each generation, kept in the
+	workspace so that a client that dies can pick up where it left off. A
+	generation is recorded as it is received (token, then where each bot's
+	source was written), built (each executable), played (the counters of the bots that
+	finished) and finally handed to the results spool, after which it is
+	forgotten. Each record is one line of JSON behind its CRC32 and is
+	synced to disk before the step it records is acted on; a torn last line
+	from a crash is ignored. The file is rewritten without the finished
+	generations when it is opened and whenever a generation finishes.
+	"""
+
+	def __init__(self, path):
+
+		self.logf = logging.getLogger('Journal')
+
+		self.path = path
+		self.mutex = threading.Lock()
+		self.generations = {}
+		self.fp = None
+
+	def open(self):
+		"""
+		Replays the journal and returns the generations that were still in
+		flight, oldest first.
+		"""
+
+		with self.mutex:
+			for record in self.read():
+				number = record['generation']
+				if number not in self.generations:
+					self.generations[number] = GenerationRecord(number)
+				self.generations[number].apply(record)
+
+			for number, generation in self.generations.items():
+				if generation.done or not generation.token:
+					del self.generations[number]
+
+			self.rewrite()
+
+		return [ self.generations[number] for number in sorted(self.generations) ]
+
+	def read(self):
+
+		records = []
+		if not os.path.exists(self.path):
+			return records
+
+		fp = open(self.path, 'rb')
+		try:
+			for line in fp:
+				try:
+					crc, data = line.rstrip('\n').split(' ', 1)
+					if int(crc, 16) != zlib.crc32(data) & 0xffffffff:
+						raise ValueError('bad checksum')
+					records.append(json.loads(data))
+				except ValueError:
+					self.logf.warning('Ignoring a damaged record after %d good ones in %s', len(records), self.path)
+					break
+		finally:
+			fp.close()
+
+		return records
+
+	def rewrite(self):
+		"Replaces the journal with just the generations still in flight"
+
+		if self.fp:
+			self.fp.close()
+
+		directory = os.path.dirname(os.path.abspath(self.path))
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+		tmpPath = self.path + '.tmp'
+		self.fp = open(tmpPath, 'wb')
+		for number in sorted(self.generations):
+			for record in self.generations[number].records():
+				self.write(record)
+		self.sync()
+		os.rename(tmpPath, self.path)
+
+		fd = os.open(directory, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	def write(self, record):
+
+		data = json.dumps(record, sort_keys=True)
+		self.fp.write('%08x %s\n' % (zlib.crc32(data) & 0xffffffff, data))
+
+	def sync(self):
+
+		self.fp.flush()
+		os.fsync(self.fp.fileno())
+
+	def append(self, op, number, sync=True, **fields):
+		"""
+		Records a step of generation number. Records appended with sync off
+		are made durable by the next synced one.
+		"""
+
+		record = dict(fields, op=op, generation=number)
+		with self.mutex:
+			if self.fp is None:
+				self.rewrite()
+
+			generation = self.generations.get(number)
+			if generation is None:
+				generation = self.generations[number] = GenerationRecord(number)
+			generation.apply(record)
+
+			self.write(record)
+			if sync:
+				self.sync()
+
+			if generation.done:
+				del self.generations[number]
+				self.rewrite()
+
+	def commit(self):
+		"Makes everything appended so far durable"
+
+		with self.mutex:
+			if self.fp:
+				self.sync()
+
+	def close(self):
+
+		with self.mutex:
+			if self.fp:
+				self.fp.close()
+				self.fp = None
@@ -0,0 +1,189 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import threading
+
+from select import select
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0x00080000
+
+READ_SIZE = 65536
+
+def openInotify(directory):
+	"""
+	Returns a non-blocking inotify descriptor watching directory for
+	changes, or None where inotify isn't available.
+	"""
+
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		inotify_init1 = libc.inotify_init1
+		inotify_add_watch = libc.inotify_add_watch
+	except (OSError, AttributeError):
+		return None
+
+	fd = inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+	if fd < 0:
+		return None
+
+	if inotify_add_watch(fd, directory, IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_TO) < 0:
+		os.close(fd)
+		return None
+
+	return fd
+
+class Tailer(object):
+	"""
+	Follows a file as it grows and hands each complete line to a callback
+	from a background thread. The file is kept open between reads and the
+	thread sleeps until inotify reports a change in the file's directory.
+	Without inotify it polls, backing off from minInterval to maxInterval
+	while the file is quiet. A file that is truncated or replaced is
+	followed from its start.
+	"""
+
+	def __init__(self, path, callback, minInterval=0.01, maxInterval=0.5, name='Tailer'):
+
+		self.logf = logging.getLogger('Tailer')
+
+		self.path = path
+		self.callback = callback
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.name = name
+
+		self.fd = None
+		self.inode = None
+		self.pos = 0
+		self.pending = ''
+
+		self.running = False
+		self.thread = None
+		self.wakeRead, self.wakeWrite = os.pipe()
+		self.inotify = openInotify(os.path.dirname(os.path.abspath(path)))
+		if self.inotify is None:
+			self.logf.debug('inotify is unavailable, polling %s', path)
+
+	def start(self):
+
+		self.running = True
+		self.thread = threading.Thread(name=self.name, target=self.run)
+		self.thread.start()
+
+	def stop(self):
+		"""
+		Stops following the file. Lines already written are delivered first.
+		"""
+
+		self.running = False
+		os.write(self.wakeWrite, 'x')
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+		self.close()
+		for fd in (self.inotify, self.wakeRead, self.wakeWrite):
+			if fd is not None:
+				os.close(fd)
+		self.inotify = self.wakeRead = self.wakeWrite = None
+
+	def run(self):
+
+		interval = self.minInterval
+		while self.running:
+
+			if self.readLines():
+				interval = self.minInterval
+			else:
+				interval = min(interval * 2, self.maxInterval)
+
+			if self.inotify is not None:
+				# The timeout only guards against missed notifications
+				ready, _, _ = select([self.inotify, self.wakeRead], [], [], self.maxInterval)
+				if self.inotify in ready:
+					self.drain(self.inotify)
+			else:
+				select([self.wakeRead], [], [], interval)
+
+		# Pick up anything written just before we were stopped
+		self.readLines()
+
+	def drain(self, fd):
+
+		try:
+			while os.read(fd, READ_SIZE):
+				pass
+		except OSError, why:
+			if why[0] != errno.EAGAIN:
+				raise
+
+	def close(self):
+
+		if self.fd is not None:
+			os.close(self.fd)
+		self.fd = None
+		self.inode = None
+		self.pos = 0
+		self.pending = ''
+
+	def reopen(self):
+		"""
+		Makes sure self.fd refers to the current file at path, starting over
+		if it has been replaced or truncated. Returns False if there is no
+		file to read yet.
+		"""
+
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return False
+
+		if self.fd is not None and (st.st_ino != self.inode or st.st_size < self.pos):
+			self.logf.debug('%s was truncated or replaced, rewinding', self.path)
+			self.close()
+
+		if self.fd is None:
+			try:
+				self.fd = os.open(self.path, os.O_RDONLY)
+			except OSError:
+				return False
+			self.inode = os.fstat(self.fd).st_ino
+
+		return True
+
+	def readLines(self):
+		"""
+		Delivers every complete line appended since the last read. Returns
+		True if anything was read.
+		"""
+
+		if not self.reopen():
+			return False
+
+		chunks = []
+		while True:
+			data = os.read(self.fd, READ_SIZE)
+			if not data:
+				break
+			chunks.append(data)
+			self.pos = self.pos + len(data)
+
+		if not chunks:
+			return False
+
+		lines = (self.pending + ''.join(chunks)).split('\n')
+		self.pending = lines.pop()
+		for line in lines:
+			try:
+				self.callback(line + '\n')
+			except:
+				self.logf.error('Error handling line from %s: %s', self.path, line, exc_info=True)
+
+		return True
@@ -0,0 +1,245 @@
+from __future__ import with_statement
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# Upper bounds in seconds, wide enough for anything from an RPC round trip
+# to a whole match
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+		1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+def formatLabels(labels, extra=None):
+
+	items = sorted(labels)
+	if extra:
+		items.append(extra)
+	if not items:
+		return ''
+	return '{%s}' % ','.join([ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items ])
+
+def formatValue(value):
+
+	if isinstance(value, (int, long)):
+		return str(value)
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
+
+class Counter(object):
+
+	kind = 'counter'
+
+	def __init__(self, labels):
+		self.labels = labels
+		self.value = 0
+		self.mutex = threading.Lock()
+
+	def inc(self, amount=1):
+		with self.mutex:
+			self.value = self.value + amount
+
+	def samples(self, name):
+		return [ (name + formatLabels(self.labels), self.value) ]
+
+	def snapshot(self):
+		return self.value
+
+class Histogram(object):
+	"Counts observations into fixed buckets, as a Prometheus histogram does"
+
+	kind = 'histogram'
+
+	def __init__(self, labels, buckets=BUCKETS):
+		self.labels = labels
+		self.buckets = buckets
+		self.counts = [ 0 ] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.mutex = threading.Lock()
+
+	def observe(self, value):
+
+		i = bisect.bisect_left(self.buckets, value)
+		with self.mutex:
+			self.counts[i] = self.counts[i] + 1
+			self.sum = self.sum + value
+			self.count = self.count + 1
+
+	def samples(self, name):
+
+		with self.mutex:
+			counts, total, count = list(self.counts), self.sum, self.count
+
+		samples = []
+		cumulative = 0
+		for bound, n in zip(self.buckets + (float('inf'),), counts):
+			cumulative = cumulative + n
+			samples.append((name + '_bucket' + formatLabels(self.labels, ('le', formatValue(bound))), cumulative))
+		samples.append((name + '_sum' + formatLabels(self.labels), total))
+		samples.append((name + '_count' + formatLabels(self.labels), count))
+		return samples
+
+	def snapshot(self):
+
+		with self.mutex:
+			return {'count':self.count, 'sum':self.sum,
+					'buckets':dict(zip([ formatValue(b) for b in self.buckets + (float('inf'),) ], self.counts))}
+
+class Span(object):
+	"Times a with block into a histogram"
+
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.started = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		self.elapsed = time.time() - self.started
+		self.histogram.observe(self.elapsed)
+		return False
+
+def timed(name, help='', **labels):
+	"Decorates a function so that every call is timed into a histogram"
+
+	def decorate(fn):
+		histogram = registry.histogram(name, help, **labels)
+		def wrapper(*args, **kwargs):
+			started = time.time()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				histogram.observe(time.time() - started)
+		wrapper.__name__ = fn.__name__
+		wrapper.__doc__ = fn.__doc__
+		return wrapper
+	return decorate
+
+class Registry(object):
+	"""
+	Every counter and histogram in the client, by name and labels. Metrics
+	are created on first use and updating one costs a dictionary lookup and
+	an uncontended lock.
+	"""
+
+	def __init__(self):
+		self.mutex = threading.Lock()
+		self.families = {}
+		self.metrics = {}
+
+	def get(self, cls, name, help, labels):
+
+		key = (name, tuple(sorted(labels.iteritems())))
+		metric = self.metrics.get(key)
+		if metric is None:
+			with self.mutex:
+				metric = self.metrics.get(key)
+				if metric is None:
+					metric = self.metrics[key] = cls(key[1])
+					self.families.setdefault(name, (cls.kind, help, []))[2].append(metric)
+		return metric
+
+	def counter(self, name, help='', **labels):
+		return self.get(Counter, name, help, labels)
+
+	def histogram(self, name, help='', **labels):
+		return self.get(Histogram, name, help, labels)
+
+	def span(self, name, help='', **labels):
+		return Span(self.histogram(name, help, **labels))
+
+	def prometheus(self):
+		"The metrics in the Prometheus text exposition format"
+
+		with self.mutex:
+			families = sorted([ (name, kind, help, list(metrics)) for name, (kind, help, metrics) in self.families.iteritems() ])
+
+		lines = []
+		for name, kind, help, metrics in families:
+			if help:
+				lines.append('# HELP %s %s' % (name, help))
+			lines.append('# TYPE %s %s' % (name, kind))
+			for metric in metrics:
+				for sample, value in metric.samples(name):
+					lines.append('%s %s' % (sample, formatValue(value)))
+		return '\n'.join(lines) + '\n'
+
+	def snapshot(self):
+		"The metrics as a dictionary, for the JSON lines export"
+
+		with self.mutex:
+			metrics = self.metrics.items()
+		return dict([ (name + formatLabels(labels), metric.snapshot()) for (name, labels), metric in metrics ])
+
+registry = Registry()
+
+counter = registry.counter
+histogram = registry.histogram
+span = registry.span
+
+class Exporter(object):
+	"""
+	Writes the registry out every metrics.interval seconds: to
+	metrics.textfile in the Prometheus format, replaced atomically so the
+	node exporter's textfile collector never sees half a file, and as one
+	JSON object per line appended to metrics.jsonl.
+	"""
+
+	def __init__(self, config, registry=registry):
+
+		self.logf = logging.getLogger('Metrics')
+
+		self.registry = registry
+		self.textfile = config.get('metrics.textfile')
+		self.jsonl = config.get('metrics.jsonl')
+		self.interval = config.get('metrics.interval') or 15.0
+
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+
+		if not (self.textfile or self.jsonl):
+			return self
+
+		self.thread = threading.Thread(name='MetricsExporter', target=self.run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+		self.export()
+
+	def run(self):
+
+		while True:
+			self.stopped.wait(self.interval)
+			if self.stopped.isSet():
+				return
+			self.export()
+
+	def export(self):
+
+		try:
+			if self.textfile:
+				tmpPath = self.textfile + '.tmp'
+				fp = open(tmpPath, 'w')
+				fp.write(self.registry.prometheus())
+				fp.close()
+				os.rename(tmpPath, self.textfile)
+
+			if self.jsonl:
+				fp = open(self.jsonl, 'a')
+				fp.write(json.dumps({'time':time.time(), 'metrics':self.registry.snapshot()}, sort_keys=True) + '\n')
+				fp.close()
+		except (IOError, OSError):
+			self.logf.warning('Failed to export metrics', exc_info=True)
@@ -6,10 +6,32 @@ import re
 import threading
 import time
 
-from Queue import Queue
+from Queue import Queue, Empty
 
+import asyncPipe
+import metrics
+import rpc
+
+from bot import command, PROXY_CALL_TIMEOUT
+from eventLog import EventLog
+from referee import Referee
+from logTail import Tailer
+
+# Longest wait between console reads when inotify is unavailable
 QCONSOLE_POLL_INTERVAL = 0.5
 
+# Longest wait for the console to confirm a command
+COMMAND_TIMEOUT = 10.0
+
+# Longest wait for a freshly launched server to initialize
+LAUNCH_TIMEOUT = 60.0
+
+SERVER_SECONDS = 'q2gp_server_seconds'
+CONNECT_SECONDS = metrics.histogram('q2gp_connect_seconds', 'Time to launch and connect all of the bots in a match')
+MATCH_SECONDS = metrics.histogram('q2gp_match_seconds', 'Time from the start of a match until the referee ends it')
+TEARDOWN_SECONDS = metrics.histogram('q2gp_teardown_seconds', 'Time to stop, disconnect and quit the bots after a match')
+CONNECT_FAILURES = metrics.counter('q2gp_connect_failures_total', 'Bots dropped from a match because they could not connect')
+
 class DmFlags(object):
 	NO_HEALTH = 1
 	NO_POWERUPS = 2
@@ -28,20 +50,223 @@ class DmFlags(object):
 	QUAD_DROP = 16384
 	FIXED_FOV = 32768
 
+## CONSOLE EVENTS ############################################################
+
+class FragEvent(object):
+	"A bot was killed by another bot"
+	
+	kind = 'frag'
+	
+	def __init__(self, victim, attacker, cause):
+		self.victim = victim
+		self.attacker = attacker
+		self.cause = cause
+
+class SuicideEvent(object):
+	"A bot died by its own hand or the map's"
+	
+	kind = 'suicide'
+	
+	def __init__(self, victim, cause):
+		self.victim = victim
+		self.cause = cause
+
+class ServerEvent(object):
+	"A change in the state of the server itself, or of a client on it"
+	
+	kind = 'server'
+	
+	def __init__(self, state, name=None):
+		self.state = state
+		self.name = name
+
+# Frag obituaries: (verb phrase, text following the attacker's name)
+FRAG_OBITUARIES = [
+	('was blasted by', ''),
+	('was gunned down by', ''),
+	('was blown away by', '\'s super shotgun'),
+	('was machinegunned by', ''),
+	('was cut in half by', '\'s chaingun'),
+	('was popped by', '\'s grenade'),
+	('ate', '\'s rocket'),
+	('almost dodged', '\'s rocket'),
+	('was melted by', '\'s hyperblaster'),
+	('was railed by', ''),
+	('saw the pretty lights from', '\'s BFG'),
+	('was disintegrated by', '\'s BFG blast'),
+	('couldn\'t hide from', '\'s BFG'),
+	('caught', '\'s handgrenade'),
+	('didn\'t see', '\'s handgrenade'),
+	('feels', '\'s pain'),
+	('tried to invade', '\'s personal space'),
+]
+
+SUICIDE_OBITUARIES = [
+	'suicides',
+	'cratered',
+	'was squished',
+	'sank like a rock',
+	'melted',
+	'does a back flip into the lava',
+	'blew up',
+	'found a way out',
+	'saw the light',
+	'was in the wrong place',
+	'tried to put the pin back in',
+	'should have used a smaller gun',
+	'tripped on its own grenade',
+	'tripped on her own grenade',
+	'tripped on his own grenade',
+	'blew itself up',
+	'blew herself up',
+	'blew himself up',
+	'killed itself',
+	'killed herself',
+	'killed himself',
+]
+
+SERVER_MESSAGES = {
+	'-------- Server Initialized ---------\n': 'initialized',
+	'-------------------------------------\n': 'initialized',
+}
+
+OBITUARIES = dict(FRAG_OBITUARIES)
+OBITUARIES.update([ (phrase, None) for phrase in SUICIDE_OBITUARIES ])
+
+KICKED_RE = re.compile('([^ ]+) was kicked\n')
+
+# Every obituary is "<victim> <verb phrase>..." so a single alternation over
+# the verb phrases, longest first, identifies the message in one pass.
+OBITUARY_RE = re.compile('([^ ]+) (%s)(.*)\n' %
+		'|'.join([ re.escape(verb) for verb in sorted(OBITUARIES, key=len, reverse=True) ]))
+
+def parseConsoleLine(line):
+	"""
+	Parses a line of the Quake2 console into a FragEvent, SuicideEvent or
+	ServerEvent. Returns None for lines that aren't of interest.
+	"""
+	
+	state = SERVER_MESSAGES.get(line)
+	if state:
+		return ServerEvent(state)
+	
+	match = OBITUARY_RE.match(line)
+	if not match:
+		match = KICKED_RE.match(line)
+		if match:
+			return ServerEvent('kicked', match.group(1))
+		return None
+	
+	victim, verb, rest = match.groups()
+	suffix = OBITUARIES[verb]
+	if suffix is None:
+		if rest:
+			return None
+		return SuicideEvent(victim, verb)
+	
+	# rest is " <attacker><suffix>"
+	if not rest.startswith(' ') or not rest.endswith(suffix):
+		return None
+	attacker = rest[1:len(rest) - len(suffix)]
+	if not attacker or ' ' in attacker:
+		return None
+	
+	return FragEvent(victim, attacker, verb)
+
+def serverState(state, name=None):
+	"A console predicate for a ServerEvent"
+	
+	def predicate(line, event):
+		return isinstance(event, ServerEvent) and event.state == state and (name is None or event.name == name)
+	return predicate
+
+class ConsoleWaiter(object):
+	"Waits for a console line satisfying a predicate"
+	
+	def __init__(self, predicate):
+		self.predicate = predicate
+		self.event = threading.Event()
+		self.lines = []
+	
+	def feed(self, line, event):
+		
+		self.lines.append(line)
+		if self.predicate(line, event):
+			self.event.set()
+			return True
+		return False
+
+class StatusCollector(object):
+	"Recognises the end of the table printed by the status command"
+	
+	def __init__(self):
+		self.inTable = False
+	
+	def __call__(self, line, event):
+		
+		if line.startswith('map '):
+			self.inTable = True
+		elif self.inTable and not line.strip():
+			return True
+		return False
+
 class Server(object):
 
-	def __init__(self, config):
-		self.logf = logging.getLogger('Quake2')
+	def __init__(self, config, port=None, game=None):
+		"""
+		A server normally listens on quake2.port and logs to baseq2. Several
+		servers can run side by side given their own port and game directory.
+		"""
+		self.name = game or 'Quake2'
+		self.logf = logging.getLogger(self.name)
 		
 		self.q2ded = config['path.q2ded']
 		self.baseq2 =  config['path.baseq2']
-		self.port = config['quake2.port']
+		self.port = port or config['quake2.port']
+		self.game = game
+		
+		# The console log is written to the game directory
+		self.consoleDir = self.baseq2
+		if game:
+			self.consoleDir = os.path.dirname(os.path.abspath(self.baseq2)) + os.sep + game
 		
+		self.proc = None
 		self.clients = {}
+		self.skew = {}
+		self.mutex = threading.Lock()
+		
+		self.connectConcurrency = config.get('quake2.connect.concurrency') or 1
+		self.connectTimeout = config.get('quake2.connect.timeout') or PROXY_CALL_TIMEOUT
+		self.connectLatency = None
+		self.launchTimeout = config.get('quake2.launch.timeout') or LAUNCH_TIMEOUT
+		self.eventHandlers = {
+			FragEvent.kind: self.fragMessage,
+			SuicideEvent.kind: self.suicideMessage,
+			ServerEvent.kind: self.serverMessage,
+		}
+		
+		# Console watchers waiting on the outcome of a command
+		self.waiters = []
+		self.map = None
+
+		# The frags and deaths of the match in progress, which the bots'
+		# counters are kept from, saved to path.events
+		self.events = None
+		self.replayed = 0
+		self.eventDir = config.get('path.events')
+		self.eventsKept = config.get('events.keep')
+		self.matchCount = 0
+		
+		# Calls the end of each match, early when match.adaptive is on
+		self.referee = Referee(config)
+		self.matchLength = None
 
 	def clearConsole(self):
 		
-		consolePath = self.baseq2 + os.sep + 'qconsole.log'
+		if not os.path.exists(self.consoleDir):
+			os.makedirs(self.consoleDir)
+		
+		consolePath = self.consoleDir + os.sep + 'qconsole.log'
 		if os.path.exists(consolePath):
 			self.logf.debug('Removing existing Quake2 console log')
 			os.unlink(consolePath)
@@ -49,108 +274,55 @@ class Server(object):
 		
 	def openConsole(self):
 		
-		# Open the console
-		self.consolePos = 0
-		self.pollingThread = threading.Thread(name='Q2ConsolePoller',
-											target=self.pollConsole)
-		self.pollingThread.start()
-
-	def pollConsole(self):
+		# Follow the console from the start of the freshly cleared log
+		self.consoleLog = logging.getLogger(self.game and 'Q2Console.' + self.game or 'Q2Console')
+		self.tailer = Tailer(self.consoleDir + os.sep + 'qconsole.log',
+							self.consoleMessage,
+							maxInterval=QCONSOLE_POLL_INTERVAL,
+							name='%s:ConsolePoller' % self.name)
+		self.tailer.start()
 
-		logf = logging.getLogger('Q2Console')
-		while self.pollingThread:
-			
-			consolef = open(self.baseq2 + os.sep + 'qconsole.log', 'r')
-			consolef.seek(self.consolePos)
-		
-			# Keep reading until we have no events
-			for line in consolef:
-				
-				handler, match = self.parseConsoleMessage(line)
-				if handler:
-					msg = handler(match)
-					if msg:
-						logf.info('\t%s', msg.rstrip())
-					else:
-						logf.debug('\t%s', line.rstrip())
-				else:
-					logf.debug('\t%s', line.rstrip())
-				
-			self.consolePos = consolef.tell()
-			consolef.close()
-			time.sleep(QCONSOLE_POLL_INTERVAL)
+	def consoleMessage(self,line):
 
-		if not consolef.closed:
-			consolef.close()
+		logf = self.consoleLog
+		handler, event = self.parseConsoleMessage(line)
+		if handler:
+			msg = handler(event)
+			if msg:
+				logf.info('\t%s', msg)
+			elif logf.isEnabledFor(logging.DEBUG):
+				logf.debug('\t%s', line.rstrip())
+		elif logf.isEnabledFor(logging.DEBUG):
+			logf.debug('\t%s', line.rstrip())
+		
+		with self.mutex:
+			waiters = list(self.waiters)
+		for waiter in waiters:
+			if waiter.feed(line, event):
+				with self.mutex:
+					self.waiters.remove(waiter)
 
 	def closeConsole(self):
 		
-		poller = self.pollingThread
-		self.pollingThread = None
-		poller.join()
+		tailer = self.tailer
+		self.tailer = None
+		tailer.stop()
 		
 	def parseConsoleMessage(self,msg):
 		
-		def message(s):
-			return re.compile( s.replace('__', '[^ ]+') + '\\n' )
-	
-		messageTemplates = [
-			 # Frag messages
-			 (message('(__)( was blasted by )(__)'), self.fragMessage),
-			 (message('(__)( was gunned down by )(__)'), self.fragMessage),
-			 (message('(__)( was blown away by )(__)(\'s super shotgun)'), self.fragMessage),
-			 (message('(__)( was machinegunnged by )(__)'), self.fragMessage),
-			 (message('(__)( was cut in half by )(__)(\'s chaingun)'), self.fragMessage),
-			 (message('(__)( was popped by )(__)(\'s grenade)'), self.fragMessage),
-			 (message('(__)( ate )(__)(\'s rocket)'), self.fragMessage),
-			 (message('(__)( almost dodged )(__)(\'s rocket)'), self.fragMessage),
-			 (message('(__)( was melted by )(__)(\'s hyperblaster)'), self.fragMessage),
-			 (message('(__)( was railed by )(__)'), self.fragMessage),
-			 (message('(__)( saw the pretty lights from )(__)(\'s BFG)'), self.fragMessage),
-			 (message('(__)( was disintegrated by )(__)(\'s BFG blast)'), self.fragMessage),
-			 (message('(__)( couldn\'t hide from )(__)(\'s BFG)'), self.fragMessage),
-			 (message('(__)( caught )(__)(\'s handgrenade)'), self.fragMessage),
-			 (message('(__)( didn\'t see )(__)(\'s handgrenade)'), self.fragMessage),
-			 (message('(__)( feels )(__)(\'s pain)'), self.fragMessage),
-			 (message('(__)( tried to invade )(__)(\'s personal space)'), self.fragMessage),
-			 
-			 # Suicide messages
-			 (message('(__)( suicides)'), self.suicideMessage),
-			 (message('(__)( cratered)'), self.suicideMessage),
-			 (message('(__)( was squished)'), self.suicideMessage),
-			 (message('(__)( sank like a rock)'), self.suicideMessage),
-			 (message('(__)( melted)'), self.suicideMessage),
-			 (message('(__)( does a back flip into the lava)'), self.suicideMessage),
-			 (message('(__)( blew up)'), self.suicideMessage),
-			 (message('(__)( found a way out)'), self.suicideMessage),
-			 (message('(__)( saw the light)'), self.suicideMessage),
-			 (message('(__)( was in the wrong place)'), self.suicideMessage),
-			 (message('(__)( tried to put the pin back in)'), self.suicideMessage),
-			 (message('(__)( tripped on (its|her|his) own grenade)'), self.suicideMessage),
-			 (message('(__)( blew (itself|herself|himself) up)'), self.suicideMessage),
-			 (message('(__)( should have used a smaller gun)'), self.suicideMessage),
-			 (message('(__)( killed (itself|herself|himself))'), self.suicideMessage),
-			 
-			 
-			 # Server messages
-			 (message('-------- Server Initialized ---------'), self.serverInitialized),
-			 (message('-------------------------------------'), self.serverInitialized)
-			 ]
-		
 		# Match the message against the known Quake2 message templates
-		for (expr,handler) in messageTemplates:
-			
-			match = expr.match(msg)
-			if match:
-			   return handler, match
+		event = parseConsoleLine(msg)
+		if event:
+			return self.eventHandlers[event.kind], event
 		
 		return None,None
 		
 	## MESSAGE HANDLERS #######################################################
 	
-	def serverInitialized(self,match):
+	def serverMessage(self,event):
 		
-		self.readyQueue.put('ready')
+		if event.state == 'kicked':
+			return "%s was kicked." % event.name
 	
 	def timelimitHit(self,match):
 		
@@ -162,43 +334,57 @@ class Server(object):
 		self.logf.info('Fraglimit has been hit, ending game')
 		self.endGame()
 		
-	def suicideMessage(self,match):
+	def suicideMessage(self,event):
 
 		try:
 			# Lookup the bot who died
-			targ = self.clients[match.group(1)]
-			targ.stats.suicides = targ.stats.suicides + 1
+			targ = self.clients[event.victim]
+			self.record(targ, None, event.cause)
 			
 			return "%s died." % targ.name
 		except:
-			self.logf.warning('Unknown suicide: %s', match.group(1))
+			self.logf.warning('Unknown suicide: %s', event.victim)
 			
-	def fragMessage(self,match):
+	def fragMessage(self,event):
 		
 		try:
 			# Lookup the involved parties
-			targ = self.clients[match.group(1)]
-			attacker = self.clients[match.group(3)]
+			targ = self.clients[event.victim]
+			attacker = self.clients[event.attacker]
 		
 			# Update stats
-			targ.stats.deaths = targ.stats.deaths + 1
-			attacker.stats.frags = attacker.stats.frags + 1
+			self.record(targ, attacker, event.cause)
 		
 			return "%s killed %s." % (attacker.name, targ.name)
 		
 		except:
-			self.logf.warning('Unknown attacker or target: %s/%s', match.group(3), match.group(1))
+			self.logf.warning('Unknown attacker or target: %s/%s', event.attacker, event.victim)
+
+	def record(self, victim, attacker, cause):
+		"""
+		Appends a frag, or a suicide if attacker is None, to the match's event
+		log. The bots' counters are only ever brought up to date from the log.
+		"""
+		
+		events = self.events
+		events.append(victim.name, attacker and attacker.name, cause)
+		self.replayed = victim.stats.board.replay(events, self.replayed)
 
+	@metrics.timed(SERVER_SECONDS, 'Time spent in each server operation', op='launch')
 	def launch(self,options,map):
 		"""
 		Launches the quake2 dedicated server and starts up a polling thread
 		to parse the console output.		
 		"""
-		self.readyQueue = Queue(1)
+		self.map = map
 		
 		# Compute the command line args
 		args = [ self.q2ded, '+map', map ]
+		options = dict(options)
 		options['basedir'] = os.path.dirname(self.q2ded)
+		options['port'] = self.port
+		if self.game:
+			options['game'] = self.game
 		options['logfile'] = '2'
 		options['dedicated'] = '1'
 		
@@ -211,13 +397,125 @@ class Server(object):
 			self.logf.info('\t%s:\t%s', opt, value)
 		
 		self.clearConsole()
-		self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=open('/dev/null'), stderr=open('/dev/null'))
+		ready = self.expect(serverState('initialized'))
+		self.proc = asyncPipe.Popen(args, stdin=subprocess.PIPE, stdout=open('/dev/null'), stderr=open('/dev/null'), persistent=True)
+		self.proc.watch(self.serverExited)
 		self.logf.info('Launched quake2 with pid = %d', self.proc.pid)
 		self.openConsole()
 
 		# Wait for Quake2 to initialize
-		return self.readyQueue.get()
+		if not ready.event.wait(self.launchTimeout):
+			with self.mutex:
+				if ready in self.waiters:
+					self.waiters.remove(ready)
+			self.closeConsole()
+			asyncPipe.processList.killPid(self.proc.pid)
+			self.proc.wait()
+			self.proc = None
+			raise SystemError('%s: server not ready within %.1f s' % (self.name, self.launchTimeout))
+		return 'ready'
+
+	## CONSOLE COMMANDS #######################################################
+	
+	def expect(self, predicate):
+		"""
+		Returns a ConsoleWaiter that is notified once predicate(line, event)
+		is true of a console line. Register it before sending the command it
+		waits on so that the reply can't be missed.
+		"""
+		
+		waiter = ConsoleWaiter(predicate)
+		with self.mutex:
+			self.waiters.append(waiter)
+		return waiter
+	
+	def sendCommand(self, cmd, waiter=None, timeout=COMMAND_TIMEOUT):
+		"""
+		Types cmd into the server console. If a waiter is given, waits for it
+		to be notified and returns the console lines it collected; raises
+		SystemError if that takes longer than timeout.
+		"""
+		
+		if not self.proc or self.proc.poll() is not None:
+			raise SystemError('%s is not running, cannot send %s' % (self.name, cmd))
+		
+		self.logf.debug('Console << %s', cmd)
+		with self.mutex:
+			self.proc.stdin.write('%s\r\n' % cmd)
+			self.proc.stdin.flush()
+		
+		if not waiter:
+			return None
+		
+		if not waiter.event.wait(timeout):
+			with self.mutex:
+				if waiter in self.waiters:
+					self.waiters.remove(waiter)
+			raise SystemError('%s: no confirmation of %s within %.1f s' % (self.name, cmd, timeout))
+		
+		return waiter.lines
+	
+	def changeMap(self, map, timeout=COMMAND_TIMEOUT):
+		"""
+		Loads map in the running server, which also resets the match.
+		"""
+		
+		self.logf.info('Changing map to %s', map)
+		self.sendCommand('map %s' % map, self.expect(serverState('initialized')), timeout)
+		self.map = map
+	
+	def restart(self, timeout=COMMAND_TIMEOUT):
+		"""
+		Resets the match by reloading the current map.
+		"""
+		
+		self.changeMap(self.map, timeout)
+	
+	def kick(self, name, timeout=COMMAND_TIMEOUT):
+		
+		self.sendCommand('kick %s' % name, self.expect(serverState('kicked', name)), timeout)
+	
+	def status(self, timeout=COMMAND_TIMEOUT):
+		"""
+		Returns the clients on the server as a list of (score, ping, name)
+		parsed from the status table.
+		"""
+		
+		lines = self.sendCommand('status', self.expect(StatusCollector()), timeout)
+		
+		clients = []
+		for line in lines:
+			fields = line.split()
+			if len(fields) >= 4 and fields[0].isdigit():
+				clients.append((int(fields[1]), fields[2], fields[3]))
+		return clients
+	
+	def reset(self, bots=()):
+		"""
+		Gets the running server ready for a new match after a failure by
+		kicking any of bots still connected and reloading the map. Returns
+		False if the server couldn't be reset in place.
+		"""
+		
+		try:
+			connected = set([ name for score, ping, name in self.status() ])
+			for bot in bots:
+				if bot.name in connected:
+					self.kick(bot.name)
+			self.restart()
+		except:
+			self.logf.warning('Could not reset %s in place', self.name, exc_info=True)
+			return False
+		
+		self.clients.clear()
+		return True
 
+	def serverExited(self, proc):
+		"Called by the supervisor when a quake2 server process goes away"
+		
+		self.logf.info('quake2 (pid %d) %s', proc.pid, proc.exitReason())
+
+	@metrics.timed(SERVER_SECONDS, op='kill')
 	def kill(self):
 		"""
 		Disconnects all clients and brings down the quake2 server.
@@ -233,18 +531,17 @@ class Server(object):
 			return
 		
 		self.logf.info('Kill request received, disconnecting clients...')
-		for bot in self.clients.itervalues():
-			try:
-				bot.disconnect()
-				bot.quit()
-			except:
-				self.logf.error("bot: %s is defucnt, continuing" % bot.name)
+		running = [ bot for bot in self.clients.itervalues() if bot.marshalling ]
+		for cmd in running and ('disconnect', 'quit') or ():
+			for bot, error in self.broadcast(running, cmd, check=False).failures().iteritems():
+				self.logf.error("bot: %s is defucnt, continuing (%s)", bot.name, error)
+		for bot in running:
 			self.logf.info('\t%s left game', bot.name)
 		
 		self.closeConsole()
 		
 		self.logf.info('Stopping quake2...')
-		self.proc.stdin.write('quit\r\n')
+		self.sendCommand('quit')
 		self.proc.wait()
 
 		self.proc.stdin.close()
@@ -254,49 +551,143 @@ class Server(object):
 		self.proc = None
 		self.logf.info('\tQuake2 is stopped')
 
+	@metrics.timed(SERVER_SECONDS, op='runGame')
 	def runGame(self,timelimit,entrants):
 
 		self.logf.info('Launching bots:')
 		
-		# Launch the bots:
+		# Launch and connect the bots a few at a time
 		self.clients.clear()
+		started = time.time()
+		self.events = EventLog([ bot.name for bot in entrants ], started)
+		self.replayed = 0
+		pending = Queue()
 		for bot in entrants:
-
-			bot.launch()
-			self.logf.info('\t%s:\tlaunched', bot.name)
-			
-			bot.connect('localhost', str(self.port))
-
-			self.logf.info('\t%s:\tconnected', bot.name)
-			self.clients[bot.name] = bot
+			pending.put(bot)
+		
+		workers = [ threading.Thread(name='%s:connect%d' % (self.name, i), target=self.connectBots, args=(pending,))
+					for i in range(min(self.connectConcurrency, len(entrants))) ]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		
+		self.connectLatency = time.time() - started
+		CONNECT_SECONDS.observe(self.connectLatency)
+		self.logf.info('%d of %d bots connected in %.2f s', len(self.clients), len(entrants), self.connectLatency)
+		if not self.clients:
+			raise SystemError('No bots could connect to %s' % self.name)
 			
 		self.logf.info('All bots have entered the game, starting the competition')
 		
 		# Start the game.
-		for bot in self.clients.itervalues():
-			self.logf.debug('Starting %s', bot.name)
-			bot.start()
+		bots = self.clients.values()
+		self.skew = {}
+		self.broadcast(bots, 'start')
 
-		# Wait for the time to expire
-		time.sleep( 60.0 * timelimit )
+		# Wait for the time to expire, or for the referee to call the match
+		begun = time.time()
+		reason = self.referee.wait(bots, timelimit)
+		self.matchLength = time.time() - begun
+		MATCH_SECONDS.observe(self.matchLength)
 
-		self.logf.info('Time is up, ending game')
+		self.logf.info('Ending game after %.1f s (%s)', self.matchLength, reason)
 		
 		# Stop the bots from fighting first; the disconnect operation may
 		# take a few seconds, this will prevent any from gaining an unfair
 		# advantage by continuing to frag while waiting to be disconnected
-		for bot in self.clients.itervalues(): 
-			self.logf.debug('Stopping %s', bot.name)
-			bot.stop()
-		
-		# Now disconnect and quit each bot one by one.
-		for bot in self.clients.itervalues():
-			
-			self.logf.info('\t%s:\tdisconnecting', bot.name)
-			bot.disconnect()
-			self.logf.debug('\t\t\tquitting')
-			bot.quit()
-			self.logf.debug('\t\t\tok')
+		ended = time.time()
+		self.broadcast(bots, 'stop')
+		
+		# Now disconnect and quit every bot at once.
+		self.logf.info('Disconnecting %d bots', len(bots))
+		self.broadcast(bots, 'disconnect')
+		self.broadcast(bots, 'quit')
+		TEARDOWN_SECONDS.observe(time.time() - ended)
+		self.saveEvents()
 
 		# Return a list of bot stats to the caller
 		return map(lambda bot: bot.stats, self.clients.itervalues())
+
+	def saveEvents(self):
+		"Writes the event log of the match just played to path.events"
+		
+		self.matchCount = self.matchCount + 1
+		if not self.eventDir:
+			return
+		
+		path = '%s%s%s-%s-%d.q2ev' % (self.eventDir, os.sep,
+				time.strftime('%Y%m%d-%H%M%S', time.localtime(self.events.started)), self.name, self.matchCount)
+		try:
+			if not os.path.exists(self.eventDir):
+				os.makedirs(self.eventDir)
+			self.events.save(path)
+			self.logf.info('Saved %d events to %s', len(self.events), path)
+			self.pruneEvents()
+		except (IOError, OSError):
+			self.logf.warning('Failed to save the event log to %s', path, exc_info=True)
+
+	def pruneEvents(self):
+		"Removes the oldest event logs beyond the events.keep most recent"
+		
+		if not self.eventsKept:
+			return
+		
+		logs = []
+		for name in os.listdir(self.eventDir):
+			if name.endswith('.q2ev'):
+				path = self.eventDir + os.sep + name
+				try:
+					logs.append((os.path.getmtime(path), path))
+				except OSError:
+					continue
+		
+		logs.sort()
+		for mtime, path in logs[:-self.eventsKept]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass # another arena got to it first
+
+	def connectBots(self, pending):
+		"""
+		Launches and connects bots from pending until it is empty. A bot that
+		fails to launch or to connect within the timeout is dropped from the
+		match.
+		"""
+		
+		while True:
+			try:
+				bot = pending.get_nowait()
+			except Empty:
+				return
+			
+			try:
+				bot.launch()
+				self.logf.info('\t%s:\tlaunched', bot.name)
+				
+				bot.callAsync(command('connect', 'localhost', self.port)).result(self.connectTimeout)
+			except:
+				CONNECT_FAILURES.inc()
+				self.logf.warning('\t%s:\tfailed to connect, dropping it from the match', bot.name, exc_info=True)
+				if bot.proc:
+					asyncPipe.processList.killPid(bot.proc.pid)
+				continue
+			
+			self.logf.info('\t%s:\tconnected', bot.name)
+			with self.mutex:
+				self.clients[bot.name] = bot
+
+	def broadcast(self, bots, methodName, check=True):
+		"""
+		Invokes methodName on every bot at once and records how far apart the
+		bots acted on it in self.skew.
+		"""
+		
+		result = rpc.broadcast(bots, command(methodName), PROXY_CALL_TIMEOUT)
+		self.skew[methodName] = result.replySkew()
+		self.logf.info('\t%s: %d bots in %.3f s, skew %.3f s', methodName, len(bots), result.elapsed(), result.replySkew())
+		
+		if check:
+			result.check()
+		return result
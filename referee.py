@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+
+import fitness
+
+class Referee(object):
+	"""
+	Decides when a match is over. With match.adaptive off every match runs
+	for its full time limit. Otherwise the live counters are sampled every
+	match.poll seconds and the match is called once the fitness ranking of
+	the bots has held for match.stable seconds, or once nobody has fragged
+	or died for match.idle seconds. A match never ends before match.min
+	seconds nor runs past match.max seconds (or its time limit).
+	"""
+
+	def __init__(self, config):
+
+		self.logf = logging.getLogger('Referee')
+
+		self.adaptive = config.get('match.adaptive') or False
+		self.minimum = config.get('match.min') or 0.0
+		self.maximum = config.get('match.max')
+		self.stable = config.get('match.stable')
+		self.idle = config.get('match.idle')
+		self.poll = config.get('match.poll') or 1.0
+		self.formula = config.get('fitness.formula') or 'default'
+
+		self.whistle = threading.Event()
+
+	def counters(self, bots):
+		"Each bot's frags, deaths and suicides so far"
+
+		return [ (bot.stats.frags, bot.stats.deaths, bot.stats.suicides) for bot in bots ]
+
+	def ranking(self, bots, baseline):
+		"""
+		The bots' names from best to worst on what they have done since the
+		counters in baseline were taken; ties keep a fixed order.
+		"""
+
+		deltas = [ [ now - then for now, then in zip(current, start) ]
+				for current, start in zip(self.counters(bots), baseline) ]
+		scores = fitness.compute([ d[0] for d in deltas ], [ d[1] for d in deltas ],
+				[ d[2] for d in deltas ], self.formula)
+		order = sorted(range(len(bots)), key=lambda i: (-scores[i], bots[i].name))
+		return [ bots[i].name for i in order ]
+
+	def activity(self, bots):
+		"Counts every frag, death and suicide so far"
+
+		return sum([ bot.stats.frags + bot.stats.deaths + bot.stats.suicides for bot in bots ])
+
+	def stop(self):
+		"Ends the match being refereed right away"
+
+		self.whistle.set()
+
+	def wait(self, bots, timelimit):
+		"""
+		Blocks until the match between bots should end, timelimit minutes at
+		the most. Returns the reason the match ended.
+		"""
+
+		self.whistle.clear()
+		limit = 60.0 * timelimit
+		if self.maximum:
+			limit = min(limit, self.maximum)
+
+		if not self.adaptive:
+			self.whistle.wait(limit)
+			return self.whistle.isSet() and 'stopped' or 'time limit'
+
+		# The counters carry over from earlier heats, only what happens in
+		# this one counts
+		started = time.time()
+		counters = self.counters(bots)
+		ranking, rankedAt = self.ranking(bots, counters), started
+		baseline = self.activity(bots)
+		activity, activeAt = baseline, started
+
+		while True:
+			now = time.time()
+			elapsed = now - started
+			if elapsed >= limit:
+				return 'time limit'
+
+			current = self.ranking(bots, counters)
+			if current != ranking:
+				ranking, rankedAt = current, now
+
+			count = self.activity(bots)
+			if count != activity:
+				activity, activeAt = count, now
+
+			if elapsed >= self.minimum:
+				if self.stable and activity > baseline and now - rankedAt >= self.stable:
+					return 'ranking settled'
+				if self.idle and now - activeAt >= self.idle:
+					return 'idle'
+
+			self.whistle.wait(min(self.poll, limit - elapsed))
+			if self.whistle.isSet():
+				return 'stopped'
@@ -0,0 +1,178 @@
+from __future__ import with_statement
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+
+import metrics
+
+POSTED = metrics.counter('q2gp_results_posted_total', 'Generations whose results reached the GP server')
+POST_FAILURES = metrics.counter('q2gp_results_post_failures_total', 'Failed attempts to post results')
+
+SUFFIX = '.results'
+
+class ResultsSpool(object):
+	"""
+	Results waiting to be posted to the GP server. Each generation's results
+	are written to their own file under path.spool, synced to disk, before
+	anything is sent, and a background thread delivers the files oldest
+	first. A file is only removed once the server has read all of it, so
+	nothing is lost if the server is down or the client restarts; failed
+	deliveries are retried with exponential backoff between gp.retry.min and
+	gp.retry.max seconds. When a backlog has built up, the whole of it is
+	sent in one pass as soon as the server answers again.
+
+	POSTRESULTS has no acknowledgement and ends at end of file, so each
+	generation still needs a connection of its own. Delivery is confirmed
+	by the server closing its end after reading to the end of ours.
+	"""
+
+	def __init__(self, config):
+
+		self.logf = logging.getLogger('ResultsSpool')
+
+		self.path = os.path.abspath(config.get('path.spool') or './spool')
+		self.host = config['gp.host']
+		self.port = config['gp.port']
+		self.timeout = config.get('gp.timeout') or 30.0
+		self.retryMin = config.get('gp.retry.min') or 1.0
+		self.retryMax = config.get('gp.retry.max') or 300.0
+
+		self.condition = threading.Condition()
+		self.running = False
+		self.thread = None
+		self.sequence = 0
+
+		if not os.path.exists(self.path):
+			os.makedirs(self.path)
+
+	def add(self, token, results):
+		"""
+		Durably queues results, a list of (fitness, bot name), for token.
+		"""
+
+		with self.condition:
+			self.sequence = self.sequence + 1
+			name = '%.6f-%04d-%s%s' % (time.time(), self.sequence, re.sub('[^A-Za-z0-9_.-]', '_', token), SUFFIX)
+
+		data = token + '\n' + ''.join([ '%f %s\n' % (fitness, botName) for fitness, botName in results ])
+		path = self.path + os.sep + name
+		tmpPath = self.path + os.sep + '.' + name
+		fp = open(tmpPath, 'wb')
+		try:
+			fp.write(data)
+			fp.flush()
+			os.fsync(fp.fileno())
+		finally:
+			fp.close()
+		os.rename(tmpPath, path)
+		self.syncDirectory()
+
+		with self.condition:
+			self.condition.notify()
+
+		return path
+
+	def syncDirectory(self):
+
+		try:
+			fd = os.open(self.path, os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+		except OSError:
+			pass
+		finally:
+			os.close(fd)
+
+	def pending(self):
+		"The spooled files, oldest first"
+
+		names = [ name for name in os.listdir(self.path) if name.endswith(SUFFIX) and not name.startswith('.') ]
+		names.sort(key=lambda name: (float(name.split('-')[0]), name))
+		return [ self.path + os.sep + name for name in names ]
+
+	def start(self):
+
+		self.running = True
+		self.thread = threading.Thread(name='ResultsSpool', target=self.run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+
+	def stop(self, timeout=None):
+		"""
+		Waits up to timeout seconds for the backlog to drain, then stops the
+		sender. Whatever wasn't delivered stays spooled for the next run.
+		"""
+
+		deadline = timeout is not None and time.time() + timeout or None
+		with self.condition:
+			while self.thread and self.pending():
+				remaining = deadline and deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					break
+				self.condition.wait(min(remaining or 1.0, 1.0))
+			self.running = False
+			self.condition.notifyAll()
+
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+
+		delay = self.retryMin
+		while self.running:
+			backlog = self.pending()
+			if not backlog:
+				with self.condition:
+					self.condition.notifyAll()
+					if self.running and not self.pending():
+						self.condition.wait(1.0)
+				continue
+
+			if len(backlog) > 1:
+				self.logf.info('Posting a backlog of %d results', len(backlog))
+
+			try:
+				for path in backlog:
+					self.send(path)
+					os.remove(path)
+					POSTED.inc()
+					delay = self.retryMin
+			except (socket.error, IOError, OSError), why:
+				POST_FAILURES.inc()
+				self.logf.warning('Failed to post results to %s:%d (%s), retrying in %.0f s', self.host, self.port, why, delay)
+
+				# Back off, with some jitter so that clients don't retry in step
+				with self.condition:
+					if self.running:
+						self.condition.wait(delay * random.uniform(0.8, 1.2))
+				delay = min(delay * 2, self.retryMax)
+
+	def send(self, path):
+
+		fp = open(path, 'rb')
+		try:
+			data = fp.read()
+		finally:
+			fp.close()
+
+		token = data.split('\n', 1)[0]
+		self.logf.info('Posting results to %s:%d with token %s', self.host, self.port, token)
+
+		s = socket.create_connection((self.host, self.port), self.timeout)
+		try:
+			s.sendall('POSTRESULTS\n' + data)
+
+			# The server has everything once it closes its end in return
+			s.shutdown(socket.SHUT_WR)
+			while s.recv(4096):
+				pass
+		finally:
+			s.close()
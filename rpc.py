@@ -0,0 +1,317 @@
+from __future__ import with_statement
+import collections
+import logging
+import os
+import threading
+import time
+
+from select import select
+
+import asyncPipe
+import metrics
+
+RPC_SECONDS = metrics.histogram('q2gp_rpc_seconds', 'Round trip of a command to a bot')
+RPC_TIMEOUTS = metrics.counter('q2gp_rpc_timeouts_total', 'Commands a bot did not answer in time')
+
+class RpcError(SystemError):
+	"A command could not be completed by a bot"
+
+class RpcTimeout(RpcError):
+	"A bot did not reply to a command in time"
+
+class Future(object):
+	"The eventual reply of a bot to one command"
+
+	def __init__(self, command):
+		self.command = command
+		self.sent = time.time()
+		self.replied = None
+
+		self.value = None
+		self.error = None
+		self.event = threading.Event()
+
+	def set(self, value):
+		self.value = value
+		self.replied = time.time()
+		self.event.set()
+		RPC_SECONDS.observe(self.replied - self.sent)
+
+	def fail(self, error):
+		self.error = error
+		self.replied = time.time()
+		self.event.set()
+
+	def done(self):
+		return self.event.isSet()
+
+	def result(self, timeout=None):
+		"""
+		Waits for the reply and returns it, raising RpcTimeout if it doesn't
+		arrive within timeout seconds or RpcError if the bot went away.
+		"""
+
+		if not self.event.wait(timeout):
+			RPC_TIMEOUTS.inc()
+			raise RpcTimeout('%s timed out' % self.command)
+		if self.error:
+			raise self.error
+		return self.value
+
+class Channel(object):
+	"The pipes to one running bot, and the commands awaiting its replies"
+
+	def __init__(self, bot, proc):
+		self.bot = bot
+		self.proc = proc
+		self.fd = proc.stdout.fileno()
+		self.reader = proc.lineReader()
+		self.mutex = threading.Lock()
+		self.pending = collections.deque()
+		self.closed = False
+
+class RpcEngine(object):
+	"""
+	Talks to every running bot from a single thread. Commands are written
+	straight to a bot's stdin by the caller and each gets a Future; the
+	engine thread waits on all the bots' stdout pipes at once and resolves
+	the futures in order as the 'return ...' replies come back. Several
+	commands may be outstanding on one bot at a time. When the supervisor
+	sees a bot exit, whatever it wrote last is read and anything still
+	waiting on it fails at once, even if something it forked holds its
+	pipe open.
+	"""
+
+	def __init__(self):
+
+		self.logf = logging.getLogger('RpcEngine')
+
+		self.mutex = threading.Lock()
+		self.channels = {}
+		self.dead = []
+		self.thread = None
+		self.wakeRead, self.wakeWrite = os.pipe()
+
+	def register(self, bot, proc):
+		"""
+		Starts handling the pipes of a freshly launched bot.
+		"""
+
+		channel = Channel(bot, proc)
+		with self.mutex:
+			self.channels[channel.fd] = channel
+			if not self.thread:
+				self.thread = threading.Thread(name='RpcEngine', target=self.run)
+				self.thread.setDaemon(True)
+				self.thread.start()
+
+		self.wake()
+		proc.watch(lambda proc: self.exited(channel))
+		return channel
+
+	def exited(self, channel):
+		"Called by the supervisor once the bot's process has been reaped"
+
+		with self.mutex:
+			self.dead.append(channel)
+		self.wake()
+
+	def wake(self):
+		os.write(self.wakeWrite, 'x')
+
+	def call(self, channel, command):
+		"""
+		Sends command to the bot on channel and returns a Future for its reply.
+		"""
+
+		future = Future(command)
+		if not channel:
+			future.fail(RpcError('No bot is running to receive %s' % command))
+			return future
+
+		with channel.mutex:
+			if channel.closed:
+				future.fail(RpcError('%s has exited' % channel.bot.name))
+				return future
+
+			# Queue first so that the reply can't beat us to the deque
+			channel.pending.append(future)
+			channel.bot.logf.debug('%s << %s', channel.bot.name, command)
+			try:
+				data = '%s\n' % command
+				while data:
+					written = os.write(channel.proc.stdin.fileno(), data)
+					data = data[written:]
+			except OSError, why:
+				channel.pending.remove(future)
+				future.fail(RpcError('%s: %s' % (channel.bot.name, why)))
+
+		return future
+
+	def run(self):
+
+		while True:
+			with self.mutex:
+				dead, self.dead = self.dead, []
+			for channel in dead:
+				self.drain(channel)
+
+			with self.mutex:
+				fds = self.channels.keys()
+
+			ready, _, _ = select(fds + [self.wakeRead], [], [], 1.0)
+			for fd in ready:
+				if fd == self.wakeRead:
+					os.read(self.wakeRead, 4096)
+					continue
+
+				with self.mutex:
+					channel = self.channels.get(fd)
+				if channel:
+					self.receive(channel)
+
+	def drain(self, channel):
+		"""
+		Handles the last of what an exited bot wrote and closes its channel,
+		without waiting on a pipe that something else may still hold open.
+		"""
+
+		if channel.closed:
+			return
+
+		while self.receive(channel):
+			pass
+
+		if not channel.closed:
+			self.close(channel)
+
+	def receive(self, channel):
+		"Handles what the bot has written; returns False once there's no more"
+
+		try:
+			lines = channel.reader.read()
+		except (IOError, OSError):
+			lines = None
+
+		if lines is None:
+			self.close(channel)
+			return False
+		if not lines:
+			return False
+
+		debug = channel.bot.logf.isEnabledFor(logging.DEBUG)
+		for line in lines:
+			if not line.startswith('return '):
+				if debug:
+					channel.bot.logf.debug('%s: %s', channel.bot.name, line)
+				continue
+
+			result = line[len('return '):]
+			if debug:
+				channel.bot.logf.debug('%s >> %s', channel.bot.name, result)
+			with channel.mutex:
+				future = channel.pending and channel.pending.popleft()
+			if future:
+				future.set(result)
+			else:
+				self.logf.warning('Unexpected reply from %s: %s', channel.bot.name, result)
+		return True
+
+	def close(self, channel):
+		"""
+		The bot closed its end of the pipe or exited: fail anything still
+		waiting on it and wait for the supervisor to reap the process.
+		"""
+
+		with self.mutex:
+			self.channels.pop(channel.fd, None)
+
+		# A bot that closed its stdout is of no further use even if it hasn't
+		# quite exited yet
+		proc = channel.proc
+		if proc.poll() is None:
+			asyncPipe.processList.killPid(proc.pid)
+		proc.wait()
+
+		with channel.mutex:
+			channel.closed = True
+			pending = list(channel.pending)
+			channel.pending.clear()
+
+		for future in pending:
+			future.fail(RpcError('%s %s before replying to %s' % (channel.bot.name, proc.exitReason(), future.command)))
+
+		proc.stdin.close()
+		proc.stdout.close()
+
+		channel.bot.exited(proc.returncode)
+
+engine = RpcEngine()
+
+class Broadcast(object):
+	"The replies of a group of bots to the same command"
+
+	def __init__(self, command, futures):
+		self.command = command
+		self.futures = futures
+
+	def failures(self):
+		"""
+		Maps each bot that failed or didn't reply in time to its error.
+		"""
+
+		failures = {}
+		for bot, future in self.futures.iteritems():
+			if not future.done():
+				failures[bot] = RpcTimeout('%s: %s timed out' % (bot.name, self.command))
+			elif future.error:
+				failures[bot] = future.error
+		return failures
+
+	def check(self):
+		"Raises the first failure, if any"
+
+		for error in self.failures().itervalues():
+			raise error
+
+	def sendSkew(self):
+		"Seconds between the command reaching the first and the last bot"
+
+		sent = [ future.sent for future in self.futures.itervalues() ]
+		return sent and max(sent) - min(sent) or 0.0
+
+	def replySkew(self):
+		"Seconds between the first and the last bot acknowledging the command"
+
+		replied = [ future.replied for future in self.futures.itervalues() if future.done() and not future.error ]
+		return replied and max(replied) - min(replied) or 0.0
+
+	def elapsed(self):
+		"Seconds from the first send until the last reply"
+
+		sent = [ future.sent for future in self.futures.itervalues() ]
+		replied = [ future.replied for future in self.futures.itervalues() if future.done() ]
+		return sent and replied and max(replied) - min(sent) or 0.0
+
+def broadcast(bots, command, timeout):
+	"""
+	Sends command to every bot at once and waits for all of the replies
+	against a single deadline, so that the whole exchange takes about one
+	round trip rather than one per bot. Returns a Broadcast.
+	"""
+
+	futures = {}
+	for bot in bots:
+		futures[bot] = bot.callAsync(command)
+
+	deadline = time.time() + timeout
+	for future in futures.itervalues():
+		future.event.wait(max(0.0, deadline - time.time()))
+
+	# Counted once here rather than each time failures() reports them
+	result = Broadcast(command, futures)
+	for error in result.failures().itervalues():
+		if isinstance(error, RpcTimeout):
+			RPC_TIMEOUTS.inc()
+
+	return result
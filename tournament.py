@@ -0,0 +1,98 @@
+import logging
+import random
+
+from fitness import Fitness
+
+STRATEGIES = [ 'roundrobin', 'random', 'swiss' ]
+
+class Tournament(object):
+	"""
+	Plays a population of any size as a series of heats no larger than a
+	server can hold. Each round splits the population into heats using the
+	configured strategy:
+
+		roundrobin	deal the bots out in order, rotating who meets whom
+					from one round to the next
+		random		reshuffle the population every round
+		swiss		after the first round, group bots with similar fitness
+
+	The heats are run across the arenas and every bot's counters accumulate
+	over all of its heats, giving one fitness per bot.
+	"""
+
+	def __init__(self, config, arenas, maxHeatSize):
+
+		self.logf = logging.getLogger('Tournament')
+
+		self.arenas = arenas
+		self.heatSize = min(config.get('tournament.heatsize') or maxHeatSize, maxHeatSize)
+		self.rounds = config.get('tournament.rounds') or 1
+		self.strategy = config.get('tournament.strategy') or 'roundrobin'
+		self.random = random.Random(config.get('tournament.seed'))
+		self.fitness = Fitness(config)
+
+		if self.strategy not in STRATEGIES:
+			raise ValueError('Unknown tournament strategy: %s' % self.strategy)
+
+	def heatCount(self, population):
+		"""
+		Enough heats to respect the heat size, and at least one per arena so
+		that none of them sit idle.
+		"""
+
+		needed = (population + self.heatSize - 1) / self.heatSize
+		return min(population, max(needed, len(self.arenas)))
+
+	def heats(self, bots, round):
+
+		count = self.heatCount(len(bots))
+
+		if self.strategy == 'random':
+			bots = list(bots)
+			self.random.shuffle(bots)
+			return [ bots[i::count] for i in range(count) ]
+
+		if self.strategy == 'swiss' and round > 0:
+			# Contiguous slices of the standings, sizes differing by at most one
+			ranked = self.fitness.rank(bots)
+			return [ ranked[i * len(ranked) / count:(i + 1) * len(ranked) / count] for i in range(count) ]
+
+		# Deal the bots out like cards; each later round shifts every row of
+		# the deal by a further heat so that bots meet new opponents
+		heats = [ [] for i in range(count) ]
+		for i, bot in enumerate(bots):
+			heats[(i + round * (i / count)) % count].append(bot)
+
+		return heats
+
+	def run(self, timelimit, bots):
+		"""
+		Plays every round and returns the bots that completed all of their
+		heats. Raises SystemError if no bot did. An empty population plays
+		nothing and has an empty result.
+		"""
+
+		if not bots:
+			self.logf.warning('No bots to play, posting an empty result')
+			return []
+
+		entrants = list(bots)
+		for round in range(self.rounds):
+
+			heats = self.heats(entrants, round)
+			self.logf.info('Round %d of %d: %d bots in %d heats of up to %d',
+						round + 1, self.rounds, len(entrants), len(heats), max(map(len, heats)))
+
+			completed = self.arenas.runHeats(timelimit, heats)
+
+			# A bot that missed a heat can't be ranked fairly against the rest
+			entrants = [ bot for heat in completed for bot in heat ]
+			if len(completed) < len(heats):
+				self.logf.warning('%d of %d heats failed in round %d', len(heats) - len(completed), len(heats), round + 1)
+
+			if not entrants:
+				raise SystemError('No heats completed in round %d' % (round + 1))
+
+		# Keep the population's original order
+		finishers = set(entrants)
+		return [ bot for bot in bots if bot in finishers ]